@@ -1,2 +1,3 @@
 from .main import main_func, snappy_step_cleanup
 from .read_write import write_snappy_step_dict_template
+from .synthetic import main_synthetic
@@ -0,0 +1,127 @@
+import math
+
+import gmsh
+
+from .geometry import Volume
+
+BYTES_PER_CELL = 1.0e3 # Rough peak snappyHexMesh memory use per castellated cell
+DEFAULT_CELLS_BETWEEN_LEVELS = 3 # Value from caseDicts/mesh/generation/snappyHexMeshDict.cfg
+
+
+def get_surface_area(face_tags: list[int]) -> float:
+    """ Sum of the CAD areas of the given faces """
+    return sum(gmsh.model.occ.getMass(2, tag) for tag in face_tags)
+
+def get_volume_size(entity: Volume) -> float:
+    """ Sum of the CAD volumes of all tags in the Volume """
+    return sum(gmsh.model.occ.getMass(3, tag) for tag in entity._tags)
+
+def get_max_level(level) -> int:
+    """ Highest refinement level of a sHMD level entry, either an int or (min max) """
+    if isinstance(level, (list, tuple)):
+        return int(max(level))
+    return int(level)
+
+def get_region_inside_level(new_dict: dict, entity: Volume) -> int:
+    """ Level applied to the whole volume by 'mode inside' refinement regions, 0 if none """
+    level = 0
+    regions = new_dict["castellatedMeshControls"].get("refinementRegions", {})
+    for key, entry in regions.items():
+        if not (key == entity.name + "_refinement_region" or key.startswith(entity.name + "_refinement_region_")):
+            continue
+        if entry.get("mode") != "inside":
+            continue
+        for pair in entry.get("levels", []):
+            level = max(level, int(pair[-1]))
+    return level
+
+def get_region_surfaces(new_dict: dict, entity: Volume, step_name: str) -> list[tuple[float, int, int]]:
+    """ List of (area, level, sides) for every surface bounding or embedded in the volume """
+    surfaces = new_dict["castellatedMeshControls"]["refinementSurfaces"]
+    entries = []
+    for patch, tags in entity.exterior_patches.items():
+        level = surfaces[step_name]["regions"].get(patch, surfaces[step_name])["level"]
+        entries.append((get_surface_area(tags), get_max_level(level), 1))
+    for instance in entity.interface_patches:
+        entries.append((get_surface_area(instance.face_tags), get_max_level(surfaces[instance.name]["level"]), 1))
+    for instance in entity.baffle_patches:
+        entries.append((get_surface_area(instance.face_tags), get_max_level(surfaces[instance.name]["level"]), 2))
+    return entries
+
+def estimate_region_cells(volume: float, surfaces: list[tuple[float, int, int]], inside_level: int, cell_volume: float, n_between: int) -> float:
+    """
+    Estimate the castellated cell count of one region.
+    Each surface refined to level L is assumed to carry a band of n_between cells at every level
+    from L down to 1, so the volume refined to at least level l is the sum of area*thickness over
+    the surfaces reaching l, capped by the region volume.
+    """
+    if volume <= 0:
+        return 0.0
+    h_0 = cell_volume**(1.0/3.0)
+    max_level = max([inside_level] + [surface[1] for surface in surfaces])
+    refined_volume = [volume] # refined_volume[l] is the volume with level >= l
+    for level in range(1, max_level + 1):
+        if level <= inside_level:
+            refined_volume.append(volume)
+            continue
+        band = 0.0
+        for area, surface_level, sides in surfaces:
+            if surface_level < level:
+                continue
+            thickness = sum(n_between*h_0/2**k for k in range(level, surface_level + 1))
+            band += area*sides*thickness
+        refined_volume.append(min(volume, band))
+    refined_volume.append(0.0)
+    cells = 0.0
+    for level in range(0, max_level + 1):
+        cells += (refined_volume[level] - refined_volume[level + 1])/(cell_volume/8**level)
+    return cells
+
+def get_far_field_cells(new_dict: dict, volumes: list[Volume], step_name: str, background: dict, cell_volume: float, n_between: int) -> float:
+    """
+    Cells of the far field region: the graded background cells, with the model volumes removed from the
+    uniform center block and the refinement bands around the model exterior added.
+    """
+    surfaces = new_dict["castellatedMeshControls"]["refinementSurfaces"]
+    entries = []
+    for entity in volumes:
+        for patch, tags in entity.exterior_patches.items():
+            level = surfaces[step_name]["regions"].get(patch, surfaces[step_name])["level"]
+            entries.append((get_surface_area(tags), get_max_level(level), 1))
+    fluid_volume = background["coreVolume"] - sum(get_volume_size(entity) for entity in volumes)
+    return background["cells"] - background["coreVolume"]/cell_volume + estimate_region_cells(fluid_volume, entries, 0, cell_volume, n_between)
+
+def estimate_cell_count(new_dict: dict, volumes: list[Volume], step_name: str, config: dict, background: dict | None = None, default_region: str | None = None) -> int:
+    """
+    Estimate the castellated cell count and memory use of the snappyHexMesh run from the background
+    cell size, the configured refinement levels and the CAD areas and volumes. Prints a warning if
+    the estimate exceeds cellCountBudget or memoryBudget (GB) from snappyStepDict. background is the
+    result of write_far_field_block_mesh_dict if a far field is meshed. Its cells are reported in
+    default_region, the region the split assigns them to.
+    """
+    setup = config["snappyHexMeshSetup"]
+    dx = setup["backgroundMeshSize"]
+    cell_volume = dx[0]*dx[1]*dx[2]
+    n_between = new_dict["castellatedMeshControls"].get("nCellsBetweenLevels", DEFAULT_CELLS_BETWEEN_LEVELS)
+    print("Estimated castellated cell count")
+    regions = {}
+    if background is not None:
+        regions[default_region] = get_far_field_cells(new_dict, volumes, step_name, background, cell_volume, n_between)
+        if not setup["farField"].get("meshVolumes", True):
+            volumes = []
+    for entity in volumes:
+        cells = estimate_region_cells(get_volume_size(entity), get_region_surfaces(new_dict, entity, step_name),
+                                      get_region_inside_level(new_dict, entity), cell_volume, n_between)
+        regions[entity.name] = regions.get(entity.name, 0.0) + cells
+    for name, cells in regions.items():
+        print(f"    {name}: {cells:.3g} cells")
+    total = sum(regions.values())
+    memory = total*setup.get("bytesPerCell", BYTES_PER_CELL)/1.0e9
+    print(f"    Total: {total:.3g} cells, approximately {memory:.3g} GB for snappyHexMesh")
+    budget = setup.get("cellCountBudget")
+    if budget is not None and total > budget:
+        print(f"Warning: estimated cell count {total:.3g} exceeds cellCountBudget {budget:.3g}. Consider coarser refinement levels or backgroundMeshSize.")
+    memory_budget = setup.get("memoryBudget")
+    if memory_budget is not None and memory > memory_budget:
+        print(f"Warning: estimated memory {memory:.3g} GB exceeds memoryBudget {memory_budget:.3g} GB.")
+    return math.ceil(total)
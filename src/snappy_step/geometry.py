@@ -1,8 +1,18 @@
 import gmsh
+import os
 import re
 import math
+import time
+import fnmatch
+import tempfile
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
+from .mesh_cache import generate_cached_surface_mesh, set_mesh_options
+from .parallel_mesh import generate_parallel_surface_mesh
+
 class Volume:
     """ TODO """
     def __init__(self, tags: list[int]):
@@ -18,6 +28,7 @@ class Volume:
         self.face_dim_tags: list[tuple[int,int]] = []
         self.embedded_dim_tags: list[tuple[int,int]]  = []
         self.create_baffles_dict: dict = {}
+        self.refinement_geometry: dict = {}
         for tag in tags:
             self.face_dim_tags.extend(gmsh.model.getBoundary([(3,tag)], False, False, False))
             self.embedded_dim_tags.extend(gmsh.model.mesh.getEmbedded(3,tag))
@@ -117,10 +128,19 @@ def get_volumes() -> list[Volume]:
 def process_geometry(config: dict):
     """ TODO """
     volumes: list[Volume] = get_volumes()
-    interfaces: list[Interface] = []
     baffles: list[Baffle]= get_baffles(volumes)
+    set_inside_points(volumes, config)
+    interfaces: list[Interface] = get_interfaces(volumes)
+    return volumes, interfaces, baffles
+
+def set_inside_points(volumes: list[Volume], config: dict):
+    """ Find or read the locationInMesh points of every volume """
     for element in volumes:
         element.get_inside_point(config)
+
+def get_interfaces(volumes: list[Volume]) -> list[Interface]:
+    """ Group the faces shared by each pair of volumes into named interfaces """
+    interfaces: list[Interface] = []
     for index_a, volume_a in enumerate(volumes):
         for index_b, volume_b in enumerate(volumes):
             if index_b <= index_a:
@@ -150,7 +170,7 @@ def process_geometry(config: dict):
                     interfaces.append(Interface(volume_a,volume_b,interface_name,groups[interface_name],edges))
                     volume_a.interface_patches.append(interfaces[-1])
                     volume_b.interface_patches.append(interfaces[-1])
-    return volumes, interfaces, baffles
+    return interfaces
 
 
 def set_tag_name_group(groups: dict, dim_tag: tuple[int, int]):
@@ -280,17 +300,377 @@ def validate_gmsh_names():
             name = validate_name(name)
             gmsh.model.setEntityName(dim_tag[0], dim_tag[1], name)
 
-def load_step_file(file_path, config):
-    """ TODO """
+def get_named_bodies() -> list[tuple[tuple[int, int], str]]:
+    """ Volumes and surfaces not bounding a volume, with their full STEP label names """
+    bodies = []
+    for dim_tag in gmsh.model.getEntities(3) + gmsh.model.getEntities(2):
+        if dim_tag[0] == 2 and len(gmsh.model.getAdjacencies(2, dim_tag[1])[0]) > 0:
+            continue
+        bodies.append((dim_tag, gmsh.model.getEntityName(dim_tag[0], dim_tag[1])))
+    return bodies
+
+def print_step_tree():
+    """ Print the product/assembly tree given by the STEP label names of the bodies """
+    tree = {}
+    for dim_tag, name in get_named_bodies():
+        node = tree
+        parts = name.split("/") if name else ["(unnamed)"]
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        label = f"{parts[-1]} ({'volume' if dim_tag[0] == 3 else 'surface'} {dim_tag[1]})"
+        node[label] = {}
+    print_tree_level(tree, 0)
+
+def print_tree_level(tree: dict, depth: int):
+    """ Print one level of the label tree, indented by depth """
+    for key, children in tree.items():
+        print("    "*depth + key)
+        print_tree_level(children, depth + 1)
+
+def matches_patterns(name: str, patterns: list[str]) -> bool:
+    """ True if the full label path or the entity name matches any of the patterns """
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(name.split("/")[-1], pattern) for pattern in patterns)
+
+def filter_bodies(config: dict):
+    """
+    Keep only the bodies matching the include patterns and none of the exclude patterns of the
+    geometryFilter dictionary, and remove the rest before imprinting.
+    """
+    filters = config.get("geometryFilter")
+    if not filters:
+        return
+    include = [pattern.strip('"') for pattern in filters.get("include", [])]
+    exclude = [pattern.strip('"') for pattern in filters.get("exclude", [])]
+    removed = []
+    kept = 0
+    for dim_tag, name in get_named_bodies():
+        if (include and not matches_patterns(name, include)) or matches_patterns(name, exclude):
+            removed.append(dim_tag)
+        else:
+            kept += 1
+    gmsh.model.occ.remove(removed, recursive=True)
+    gmsh.model.occ.synchronize()
+    print(f"Geometry filter kept {kept} bodies and removed {len(removed)}")
+    if kept == 0:
+        print("No bodies left after applying geometryFilter. Exiting")
+        gmsh.finalize()
+        exit(1)
+
+def set_import_options(config):
+    """ Set units and scaling used when importing STEP files """
     gmsh.option.setString('Geometry.OCCTargetUnit', 'M') # Set meters as working unit
     # Set Import Scaling
     if "gmsh" in config:
         if "scaling" in config["gmsh"]:
             gmsh.option.setNumber("Geometry.OCCScaling",config["gmsh"]["scaling"])
+
+def load_step_file(file_path, config):
+    """ TODO """
+    set_import_options(config)
     print('Reading geometry')
     gmsh.model.occ.importShapes(file_path,False)
     gmsh.model.occ.synchronize()
 
+def load_step_files(file_paths: list[str], config: dict) -> tuple[list[int], list[int], float] | None:
+    """
+    Load one or more STEP files into the current model. With several files, each file is read and
+    healed in its own worker process and exported to BRep, then the BReps are merged here. Names
+    are prefixed with the file name so they stay unique, unnamed volumes are named after the file.
+    If the workers healed the files, returns the entity counts before and after healing and the
+    healing time, summed over the files, to pass to heal_geometry.
+    """
+    if len(file_paths) == 1:
+        load_step_file(file_paths[0], config)
+        return None
+    processes = min(len(file_paths), config.get("gmsh", {}).get("importProcesses", os.cpu_count() or 1))
+    print(f'Reading {len(file_paths)} geometry files with {processes} processes')
+    with tempfile.TemporaryDirectory() as directory:
+        brep_paths = [os.path.join(directory, f"{index}.brep") for index in range(len(file_paths))]
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results = list(executor.map(convert_step_to_brep, file_paths, brep_paths, [config]*len(file_paths)))
+        gmsh.option.setNumber("Geometry.OCCScaling", 1) # BReps are already scaled
+        for file_path, brep_path, (names, _) in zip(file_paths, brep_paths, results):
+            prefix = validate_name(os.path.splitext(os.path.basename(file_path))[0])
+            merge_brep_file(brep_path, names, prefix)
+    healing = [result[1] for result in results if result[1] is not None]
+    if not healing:
+        return None
+    before, after, seconds = zip(*healing)
+    return [sum(counts) for counts in zip(*before)], [sum(counts) for counts in zip(*after)], sum(seconds)
+
+def convert_step_to_brep(file_path: str, brep_path: str, config: dict) -> tuple[list[tuple[tuple[int, bool], str, list[float]]], tuple | None]:
+    """
+    Worker process: read and heal a STEP file and write it as BRep. BRep does not store names, so
+    the named volumes and surface bodies are returned as (entity kind, name, center of mass and
+    bounding box). Names of volume faces are left out, they are removed before imprinting anyway.
+    Also returns the entity counts before and after healing and the healing time, None if not healed.
+    """
+    gmsh.initialize()
+    gmsh.option.setNumber("General.Terminal", 0)
+    set_import_options(config)
+    gmsh.model.occ.importShapes(file_path, False)
+    gmsh.model.occ.synchronize()
+    healing = None
+    if config.get("healing"):
+        before = count_entities()
+        start = time.perf_counter()
+        heal_volumes(config["healing"])
+        healing = (before, count_entities(), time.perf_counter() - start)
+    names = []
+    for dim_tag in gmsh.model.getEntities(3) + gmsh.model.getEntities(2):
+        name = gmsh.model.getEntityName(dim_tag[0], dim_tag[1])
+        kind = get_entity_kind(dim_tag)
+        if name and kind != (2, False):
+            names.append((kind, name, get_entity_signature(dim_tag)))
+    gmsh.write(brep_path)
+    gmsh.finalize()
+    return names, healing
+
+def heal_volumes(options: dict | None = None):
+    """
+    Heal each volume with OCC shape healing, keeping the volume names. Only volumes are healed, so
+    surface bodies defining patches and baffles are not sewn into shells.
+    """
+    options = options or {}
+    named_volumes = get_named_volumes()
+    for dim_tag in gmsh.model.occ.getEntities(3):
+        gmsh.model.occ.healShapes([dim_tag],
+                                  tolerance=options.get("tolerance", 1e-8),
+                                  fixDegenerated=options.get("fixDegenerated", True),
+                                  fixSmallEdges=options.get("fixSmallEdges", True),
+                                  fixSmallFaces=options.get("fixSmallFaces", True),
+                                  sewFaces=options.get("sewFaces", True),
+                                  makeSolids=options.get("makeSolids", True))
+    gmsh.model.occ.synchronize()
+    restore_volume_names(named_volumes)
+    if options.get("unifyFaces", False):
+        unify_same_domain_faces()
+
+def get_named_volumes() -> list[tuple[str, list[float]]]:
+    """ Name and signature of every named volume, used to restore the names after OCC operations """
+    named_volumes = []
+    for dim_tag in gmsh.model.getEntities(3):
+        name = gmsh.model.getEntityName(dim_tag[0], dim_tag[1])
+        if name:
+            named_volumes.append((name, get_entity_signature(dim_tag)))
+    return named_volumes
+
+def restore_volume_names(named_volumes: list[tuple[str, list[float]]]):
+    """
+    Give every named volume its name back after an OCC operation that may have renumbered volumes.
+    Each name goes to the current volume with the closest center of mass and bounding box.
+    """
+    dim_tags = gmsh.model.getEntities(3)
+    signatures = [get_entity_signature(dim_tag) for dim_tag in dim_tags]
+    matches = match_signatures([signature for _, signature in named_volumes], signatures)
+    for (name, _), index in zip(named_volumes, matches):
+        if index is not None:
+            gmsh.model.setEntityName(3, dim_tags[index][1], name)
+
+def match_signatures(signatures: list[list[float]], candidates: list[list[float]]) -> list[int | None]:
+    """
+    Index of the candidate closest to each signature. Closest pairs are assigned first and every
+    candidate is used at most once, so entities with the same signature keep separate names.
+    """
+    matches = [None]*len(signatures)
+    if not signatures or not candidates:
+        return matches
+    distances = np.linalg.norm(np.array(signatures)[:, None, :] - np.array(candidates)[None, :, :], axis=2)
+    used = set()
+    for flat_index in np.argsort(distances, axis=None, kind="stable"):
+        row, column = divmod(int(flat_index), len(candidates))
+        if matches[row] is None and column not in used:
+            matches[row] = column
+            used.add(column)
+    return matches
+
+def unify_same_domain_faces():
+    """
+    Merge faces and edges of each volume that lie on the same surface or curve. gmsh only applies
+    OCC's ShapeUpgrade_UnifySameDomain after a boolean union, so each volume is fused with a copy of itself.
+    """
+    gmsh.option.setNumber("Geometry.OCCUnionUnify", 1)
+    named_volumes = get_named_volumes()
+    for dim_tag in gmsh.model.occ.getEntities(3):
+        copy = gmsh.model.occ.copy([dim_tag])
+        out_dim_tags, _ = gmsh.model.occ.fuse([dim_tag], copy)
+        if len([out for out in out_dim_tags if out[0] == 3]) != 1:
+            print(f"Warning: could not unify the faces of volume {dim_tag[1]}")
+    gmsh.model.occ.synchronize()
+    restore_volume_names(named_volumes)
+
+def count_entities() -> list[int]:
+    """ Number of points, curves, surfaces and volumes in the model """
+    return [len(gmsh.model.getEntities(dim)) for dim in range(4)]
+
+def heal_geometry(config: dict, healed: tuple[list[int], list[int], float] | None = None):
+    """
+    Optional healing before imprinting, configured by the healing dictionary in snappyStepDict.
+    Reports the entity counts before and after. booleanTolerance sets the fuzzy tolerance of the
+    fragment operations in imprint_geometry, which closes small gaps and overlaps. healed is the
+    result of load_step_files if the files were already healed while reading, which is reported
+    instead of healing again.
+    """
+    options = config.get("healing")
+    if not options:
+        return
+    if healed is not None:
+        before, after, seconds = healed
+        print(f"Geometry files were healed while reading, which took {seconds:.2f} s in total")
+    else:
+        print("Healing geometry")
+        before = count_entities()
+        start = time.perf_counter()
+        heal_volumes(options)
+        after = count_entities()
+        print(f"Healing took {time.perf_counter() - start:.2f} s")
+    for label, count_before, count_after in zip(["points", "curves", "surfaces", "volumes"], before, after):
+        print(f"    {label}: {count_before} -> {count_after}")
+    if "booleanTolerance" in options:
+        gmsh.option.setNumber("Geometry.ToleranceBoolean", options["booleanTolerance"])
+
+def get_defeaturing_threshold(config: dict) -> float:
+    """ Width below which features are removed. Defaults to scale times the finest surface cell size. """
+    options = config["defeaturing"]
+    if "threshold" in options:
+        return options["threshold"]
+    dx = min(config["snappyHexMeshSetup"]["backgroundMeshSize"])
+    level = max(config["snappyHexMeshSetup"]["defaultSurfaceRefinement"])
+    return options.get("scale", 0.5)*dx/2**level
+
+def get_face_width(tag: int) -> float:
+    """
+    Second largest principal extent of a face, from its matrix of inertia, so it does not depend on
+    the orientation. This is the width of a fillet or chamfer strip and about the diameter of a hole.
+    """
+    inertia = np.array(gmsh.model.occ.getMatrixOfInertia(2, tag)).reshape(3, 3)
+    second_moments = np.linalg.eigvalsh(np.trace(inertia)/2*np.eye(3) - inertia)
+    return float(np.sqrt(12*max(second_moments[1], 0)/gmsh.model.occ.getMass(2, tag)))
+
+def get_features(faces: list[int]) -> list[list[int]]:
+    """ Groups of faces connected by shared curves, e.g. the wall and bottom of a hole """
+    curves = {face: set(gmsh.model.getAdjacencies(2, face)[1]) for face in faces}
+    remaining = set(faces)
+    features = []
+    while remaining:
+        stack = [remaining.pop()]
+        feature = list(stack)
+        while stack:
+            face = stack.pop()
+            neighbours = [other for other in remaining if curves[face] & curves[other]]
+            remaining.difference_update(neighbours)
+            stack.extend(neighbours)
+            feature.extend(neighbours)
+        features.append(sorted(feature))
+    return sorted(features)
+
+def get_feature_key(faces: list[int]) -> tuple:
+    """ Mean center of mass of the faces of a feature, which identifies it after volumes are renumbered """
+    return tuple(np.round(np.mean([gmsh.model.occ.getCenterOfMass(2, face) for face in faces], axis=0), 9))
+
+def remove_feature(tag: int, faces: list[int]) -> int | None:
+    """
+    Remove the faces of one feature from a volume with OCC defeaturing. Returns the tag of the new
+    volume, or None if OCC failed or removed nothing, in which case the volume is unchanged. The input
+    volume is only removed after a successful call, since OCC also removes it when defeaturing fails.
+    """
+    try:
+        out_dim_tags = gmsh.model.occ.defeature([tag], faces, removeVolume=False)
+        gmsh.model.occ.synchronize()
+    except Exception:
+        return None
+    results = [out for out in out_dim_tags if out[0] == 3 and out[1] != tag]
+    before = len(gmsh.model.getBoundary([(3, tag)], False, False, False))
+    if len(results) == 1 and len(gmsh.model.getBoundary(results, False, False, False)) < before:
+        gmsh.model.occ.remove([(3, tag)], recursive=True)
+        gmsh.model.occ.synchronize()
+        return results[0][1]
+    gmsh.model.occ.remove(results, recursive=True)
+    gmsh.model.occ.synchronize()
+    return None
+
+def defeature_geometry(config: dict):
+    """
+    Optional removal of small fillets, chamfers, holes and embossings before imprinting, configured
+    by the defeaturing dictionary in snappyStepDict. Faces narrower than the threshold are grouped
+    into features of connected faces, and every feature is removed on its own with OCC defeaturing.
+    Features OCC cannot remove are kept, with a warning. Volumes matching the exclude patterns are
+    left as they are.
+    """
+    options = config.get("defeaturing")
+    if not options:
+        return
+    threshold = get_defeaturing_threshold(config)
+    exclude = [pattern.strip('"') for pattern in options.get("exclude", [])]
+    print(f"Removing features narrower than {threshold:.3g}")
+    start = time.perf_counter()
+    removed = 0
+    for dim_tag in gmsh.model.getEntities(3):
+        name = gmsh.model.getEntityName(dim_tag[0], dim_tag[1])
+        if matches_patterns(name, exclude):
+            continue
+        tag = dim_tag[1]
+        face_count = len(gmsh.model.getBoundary([dim_tag], False, False, False))
+        kept = []
+        while True:
+            faces = [abs(face[1]) for face in gmsh.model.getBoundary([(3, tag)], False, False, False)]
+            features = [feature for feature in get_features([face for face in faces if get_face_width(face) < threshold])
+                        if get_feature_key(feature) not in kept]
+            if not features:
+                break
+            new_tag = remove_feature(tag, features[0])
+            if new_tag is None:
+                kept.append(get_feature_key(features[0]))
+                continue
+            tag = new_tag
+            if name:
+                gmsh.model.removeEntityName(name) # also drops the name of the removed volume
+                gmsh.model.setEntityName(3, tag, name)
+            removed += 1
+        new_count = len(gmsh.model.getBoundary([(3, tag)], False, False, False))
+        if new_count < face_count:
+            print(f"    {name}: {face_count} -> {new_count} faces")
+        if kept:
+            print(f"    Warning: {name}: could not remove {len(kept)} features, they were kept")
+    print(f"Defeaturing removed {removed} features in {time.perf_counter() - start:.2f} s")
+
+def get_entity_signature(dim_tag: tuple[int, int]) -> list[float]:
+    """ Center of mass followed by bounding box, used to find an entity again after BRep export """
+    return list(gmsh.model.occ.getCenterOfMass(dim_tag[0], dim_tag[1])) + list(gmsh.model.occ.getBoundingBox(dim_tag[0], dim_tag[1]))
+
+def get_entity_kind(dim_tag: tuple[int, int]) -> tuple[int, bool]:
+    """
+    Dimension and whether the entity is free, i.e. a surface body not bounding a volume. A patch
+    surface lying on a volume face has the signature of that face, so names are only matched within
+    the same kind.
+    """
+    return dim_tag[0], dim_tag[0] == 2 and len(gmsh.model.getAdjacencies(2, dim_tag[1])[0]) == 0
+
+def merge_brep_file(brep_path: str, names: list[tuple[tuple[int, bool], str, list[float]]], prefix: str):
+    """ Import a BRep written by convert_step_to_brep and restore the prefixed names """
+    existing = set(gmsh.model.getEntities())
+    gmsh.model.occ.importShapes(brep_path, False)
+    gmsh.model.occ.synchronize()
+    new_entities = {}
+    for dim_tag in gmsh.model.getEntities(3) + gmsh.model.getEntities(2):
+        if dim_tag not in existing:
+            new_entities.setdefault(get_entity_kind(dim_tag), []).append(dim_tag)
+    for kind, dim_tags in new_entities.items():
+        named = [(name, signature) for name_kind, name, signature in names if name_kind == kind]
+        matches = match_signatures([signature for _, signature in named], [get_entity_signature(dim_tag) for dim_tag in dim_tags])
+        for (name, _), index in zip(named, matches):
+            if index is not None:
+                gmsh.model.setEntityName(kind[0], dim_tags[index][1], prefix_name(name, prefix))
+    for dim_tag in new_entities.get((3, False), []):
+        if not gmsh.model.getEntityName(dim_tag[0], dim_tag[1]):
+            gmsh.model.setEntityName(dim_tag[0], dim_tag[1], prefix)
+
+def prefix_name(name: str, prefix: str) -> str:
+    """ Prefix the last part of a STEP label path, which becomes the entity name """
+    parts = name.split("/")
+    parts[-1] = prefix + "_" + parts[-1]
+    return "/".join(parts)
+
 def imprint_geometry():
     """ TODO """
     # How many volumes before coherence
@@ -301,6 +681,7 @@ def imprint_geometry():
 
     # Apply coherence to remove duplicate surfaces, edges, and points
     print('Imprinting features and removing duplicate faces')
+    start = time.perf_counter()
     if number_volumes > 1:
         gmsh.model.occ.fragment(gmsh.model.occ.getEntities(3),gmsh.model.occ.getEntities(3))
         gmsh.model.occ.removeAllDuplicates()
@@ -316,6 +697,7 @@ def imprint_geometry():
     rename_out_map_entities(input_dims, names, out_map)
     gmsh.model.occ.removeAllDuplicates()
     gmsh.model.occ.synchronize()
+    print(f"Fragment took {time.perf_counter() - start:.2f} s")
     
 def collect_entity_names() -> dict:
     names = {}
@@ -359,17 +741,41 @@ def assign_cell_zones_to_interfaces(volumes:list[Volume]) -> Volume:
                 continue
     
                 
-def generate_surface_mesh(config: dict):
+def generate_surface_mesh(config: dict, cache_directory: str | None = None, instanced_faces: set[int] | None = None):
     """ TODO """
     print("Generating Surface Mesh")
-    gmsh.option.setNumber("Mesh.Algorithm",config["gmsh"]["meshAlgorithm"])
-    gmsh.option.setNumber("Mesh.MeshSizeFactor",config["gmsh"]["meshSizeFactor"])
-    gmsh.option.setNumber("Mesh.MeshSizeMin",config["gmsh"]["meshSizeMin"])
-    gmsh.option.setNumber("Mesh.MeshSizeMax",config["gmsh"]["meshSizeMax"])
-    gmsh.option.setNumber("Mesh.MeshSizeFromCurvature",config["gmsh"]["meshSizeFromCurvature"])
-    gmsh.model.mesh.generate(2)
+    set_mesh_options(config)
+    parallel = config["gmsh"].get("meshProcesses", 1) > 1
+    if config["gmsh"].get("tessellation", "mesh") == "fast":
+        generate_fast_tessellation(config)
+    elif config["gmsh"].get("meshCache", False) and cache_directory is not None:
+        if parallel:
+            generate_cached_surface_mesh(config, cache_directory, instanced_faces, partial(generate_parallel_surface_mesh, config, instanced_faces))
+        else:
+            generate_cached_surface_mesh(config, cache_directory, instanced_faces)
+    elif parallel:
+        gmsh.model.mesh.generate(1)
+        generate_parallel_surface_mesh(config, instanced_faces)
+    else:
+        gmsh.model.mesh.generate(2)
 
     # export settings
     gmsh.option.set_number("Mesh.StlOneSolidPerSurface",2)
 
+def generate_fast_tessellation(config: dict):
+    """
+    Use the OpenCASCADE triangulation (BRepMesh_IncrementalMesh) of every face as the surface mesh
+    instead of a gmsh 2D mesh. Accuracy is set by chordalDeflection (m) and angularDeflection (degrees).
+    The default chordal deflection is 1e-3 times the diagonal of the model bounding box. The triangles stay on their face tags and coincident nodes on shared curves are merged.
+    """
+    bounds = gmsh.model.getBoundingBox(-1, -1)
+    diagonal = math.dist(bounds[:3], bounds[3:])
+    deflection = config["gmsh"].get("chordalDeflection", 1e-3*diagonal)
+    print(f"Using OpenCASCADE tessellation, chordal deflection {deflection:.3g} m")
+    gmsh.option.setNumber("Mesh.StlLinearDeflectionRelative", 0)
+    gmsh.option.setNumber("Mesh.StlLinearDeflection", deflection)
+    gmsh.option.setNumber("Mesh.StlAngularDeflection", math.radians(config["gmsh"].get("angularDeflection", 20)))
+    gmsh.model.mesh.importStl()
+    gmsh.model.mesh.removeDuplicateNodes()
+
         
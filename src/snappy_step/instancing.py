@@ -0,0 +1,172 @@
+import gmsh
+import numpy as np
+
+from .mesh_cache import get_face_mesh
+
+RELATIVE_TOLERANCE = 1e-6
+ORIENTATION_SAMPLES = 100 # triangles per face compared with the surface normal
+
+
+def get_volume_faces(tag: int) -> list[int]:
+    """ Tags of the faces bounding the volume """
+    return [dim_tag[1] for dim_tag in gmsh.model.getBoundary([(3, tag)], False, False, False)]
+
+def get_volume_curves(tag: int) -> list[int]:
+    """ Tags of the curves of all faces bounding the volume """
+    curves = set()
+    for face in get_volume_faces(tag):
+        curves.update(gmsh.model.getAdjacencies(2, face)[1])
+    return sorted(curves)
+
+def get_volume_invariants(tag: int) -> tuple:
+    """ Quantities that do not change under a rigid transformation, rounded so congruent volumes compare equal """
+    faces = get_volume_faces(tag)
+    inertia = np.array(gmsh.model.occ.getMatrixOfInertia(3, tag)).reshape(3, 3)
+    values = [gmsh.model.occ.getMass(3, tag), sum(gmsh.model.occ.getMass(2, face) for face in faces)]
+    values.extend(np.linalg.eigvalsh(inertia))
+    return tuple(f"{value:.6g}" for value in values) + (len(faces), len(get_volume_curves(tag)))
+
+def get_reference_points(tag: int) -> tuple[np.ndarray, np.ndarray, list[int]]:
+    """
+    Center of mass of the volume, and the points used to find and check the transformation: the
+    centers of mass of all faces and curves. Also returns the face tags, in the order of the face points.
+    """
+    faces = get_volume_faces(tag)
+    points = [gmsh.model.occ.getCenterOfMass(2, face) for face in faces]
+    points.extend(gmsh.model.occ.getCenterOfMass(1, curve) for curve in get_volume_curves(tag))
+    return np.array(gmsh.model.occ.getCenterOfMass(3, tag)), np.array(points), faces
+
+def get_frame(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """ Orthonormal frame (as columns) with the first axis along a and the second in the plane of a and b """
+    e1 = a/np.linalg.norm(a)
+    e2 = b - np.dot(b, e1)*e1
+    e2 /= np.linalg.norm(e2)
+    return np.stack([e1, e2, np.cross(e1, e2)], axis=1)
+
+def points_match(mapped: np.ndarray, points: np.ndarray, tolerance: float) -> bool:
+    """ True if every mapped point coincides with one of the points """
+    distances = np.linalg.norm(mapped[:, None, :] - points[None, :, :], axis=2)
+    return bool((distances.min(axis=1) < tolerance).all())
+
+def find_rotation(master: np.ndarray, copy: np.ndarray, tolerance: float) -> np.ndarray | None:
+    """
+    Rotation R with R @ master[i] matching the copy point set, both centered on the volume center of
+    mass. Two reference points of the master are matched against all copy points with the same
+    distances, which also resolves the symmetric cases where principal axes are not unique.
+    """
+    radius = np.linalg.norm(master, axis=1)
+    first = int(np.argmax(radius))
+    if radius[first] < tolerance:
+        return None
+    off_axis = np.linalg.norm(np.cross(master, master[first]/radius[first]), axis=1)
+    second = int(np.argmax(off_axis))
+    if off_axis[second] < tolerance:
+        return None
+    copy_radius = np.linalg.norm(copy, axis=1)
+    separation = np.linalg.norm(master[first] - master[second])
+    master_frame = get_frame(master[first], master[second])
+    for candidate_first in np.flatnonzero(np.abs(copy_radius - radius[first]) < tolerance):
+        candidates_second = np.flatnonzero((np.abs(copy_radius - radius[second]) < tolerance)
+                                           & (np.abs(np.linalg.norm(copy - copy[candidate_first], axis=1) - separation) < tolerance))
+        for candidate_second in candidates_second:
+            if np.linalg.norm(np.cross(copy[candidate_first], copy[candidate_second])) < tolerance*copy_radius[candidate_first]:
+                continue
+            rotation = get_frame(copy[candidate_first], copy[candidate_second]) @ master_frame.T
+            if points_match(master @ rotation.T, copy, tolerance):
+                return rotation
+    return None
+
+def get_periodic_faces(master_tag: int, copy_tag: int, tolerance: float) -> tuple[list[int], list[int], list[float]] | None:
+    """
+    Copy faces that can take a transformed copy of the master mesh, with their master faces and the
+    affine transformation from master to copy. Faces whose curves touch other volumes, e.g.
+    interfaces that need conformal imprinting, are left out and meshed normally. Mirror images are
+    not instanced, since a reflected mesh would turn inside out.
+    """
+    master_center, master_points, master_faces = get_reference_points(master_tag)
+    copy_center, copy_points, copy_faces = get_reference_points(copy_tag)
+    rotation = find_rotation(master_points - master_center, copy_points - copy_center, tolerance)
+    if rotation is None or np.linalg.det(rotation) < 0:
+        return None
+    translation = copy_center - rotation @ master_center
+    mapped = master_points[:len(master_faces)] @ rotation.T + translation
+    copy_face_set = set(copy_faces)
+    slaves = []
+    masters = []
+    for index, face in enumerate(copy_faces):
+        if any(not set(gmsh.model.getAdjacencies(1, curve)[0]).issubset(copy_face_set) for curve in gmsh.model.getAdjacencies(2, face)[1]):
+            continue
+        distances = np.linalg.norm(mapped - copy_points[index], axis=1)
+        master_index = int(np.argmin(distances))
+        if distances[master_index] > tolerance:
+            continue
+        area = gmsh.model.occ.getMass(2, face)
+        if abs(area - gmsh.model.occ.getMass(2, master_faces[master_index])) > RELATIVE_TOLERANCE*area:
+            continue
+        slaves.append(face)
+        masters.append(master_faces[master_index])
+    transform = np.eye(4)
+    transform[:3, :3] = rotation
+    transform[:3, 3] = translation
+    return slaves, masters, list(transform.reshape(-1))
+
+def set_instanced_meshes() -> tuple[set[int], list[int]]:
+    """
+    Group volumes that are congruent up to a rigid transformation and make the faces of every copy
+    periodic copies of the faces of the first volume in the group, so gmsh meshes each unique part
+    once. Returns the tags of all master and copy faces, and the copy faces to pass to
+    reverse_instanced_faces after meshing.
+    """
+    print("Detecting repeated parts")
+    groups = {}
+    for dim_tag in gmsh.model.getEntities(3):
+        groups.setdefault(get_volume_invariants(dim_tag[1]), []).append(dim_tag[1])
+    instanced_faces = set()
+    copy_faces = []
+    copies = 0
+    unique = 0
+    for tags in groups.values():
+        if len(tags) < 2:
+            continue
+        master = tags[0]
+        x_min, y_min, z_min, x_max, y_max, z_max = gmsh.model.getBoundingBox(3, master)
+        tolerance = RELATIVE_TOLERANCE*np.linalg.norm([x_max - x_min, y_max - y_min, z_max - z_min])
+        used = False
+        for tag in tags[1:]:
+            periodic = get_periodic_faces(master, tag, tolerance)
+            if periodic is None or not periodic[0]:
+                continue
+            slaves, masters, transform = periodic
+            if instanced_faces.intersection(slaves):
+                continue
+            gmsh.model.mesh.setPeriodic(2, slaves, masters, transform)
+            instanced_faces.update(slaves)
+            copy_faces.extend(slaves)
+            instanced_faces.update(masters)
+            copies += 1
+            used = True
+        unique += used
+    print(f"{copies} volumes reuse the surface mesh of {unique} unique parts")
+    return instanced_faces, copy_faces
+
+def is_mesh_reversed(tag: int) -> bool:
+    """ True if the triangles of a meshed face point against the surface normal, sampled at up to ORIENTATION_SAMPLES triangles """
+    coords, triangles, _ = get_face_mesh(tag)
+    if not len(triangles):
+        return False
+    triangles = triangles[::max(1, len(triangles)//ORIENTATION_SAMPLES)]
+    corners = coords[triangles]
+    element_normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    parameters = gmsh.model.getParametrization(2, tag, list(corners.mean(axis=1).reshape(-1)))
+    surface_normals = np.array(gmsh.model.getNormal(tag, parameters)).reshape(-1, 3)
+    return float(np.einsum("ij,ij->i", element_normals, surface_normals).sum()) < 0
+
+def reverse_instanced_faces(copy_faces: list[int]):
+    """
+    Flip the elements of copy faces whose mesh, copied from the master with the master node order,
+    points against the surface normal of the copy, so all faces are oriented as if meshed normally.
+    """
+    reversed_faces = [tag for tag in copy_faces if is_mesh_reversed(tag)]
+    if reversed_faces:
+        print(f"Reversing the mesh of {len(reversed_faces)} instanced faces")
+        gmsh.model.mesh.reverse([(2, tag) for tag in reversed_faces])
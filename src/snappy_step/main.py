@@ -1,12 +1,17 @@
 import argparse
 from .geometry import *
 from .read_write import *
+from .estimate import *
+from .surface_check import *
+from .refinement import *
+from .instancing import *
 
-def run_snappy_step(file_name,v,vf):
+def run_snappy_step(file_name,v,vf,list_tree=False):
     """
     :param file_name: TODO
     :param v: TODO
     :v vf: TODO
+    :param list_tree: Print the STEP assembly tree and entity names, then exit
     """
     # Determine if in openfoam case structure and if it is .org or .com version
     geometry_path = get_geometry_path()
@@ -16,12 +21,22 @@ def run_snappy_step(file_name,v,vf):
     validate_snappy_step_dict(config)
     
     # Find geometry files
-    step_file = find_geometry_file(file_name, geometry_path)
-    step_name = os.path.split(step_file)[-1].split('.')[0]
+    step_files = find_geometry_files(file_name, geometry_path, config)
+    if len(step_files) == 1:
+        step_name = os.path.split(step_files[0])[-1].split('.')[0]
+    else:
+        step_name = validate_name(os.path.basename(os.getcwd()))
 
     # Begin gmsh operations
     gmsh.initialize()
-    load_step_file(step_file, config)
+    healed = load_step_files(step_files, config)
+    if list_tree:
+        print_step_tree()
+        gmsh.finalize()
+        return
+    filter_bodies(config)
+    heal_geometry(config, healed)
+    defeature_geometry(config)
     imprint_geometry()
     validate_gmsh_names()
 
@@ -46,30 +61,59 @@ def run_snappy_step(file_name,v,vf):
 
 
     # Generate Mesh
-    generate_surface_mesh(config)
+    instanced_faces = set()
+    copy_faces = []
+    if config["gmsh"].get("instancing", False) and config["gmsh"].get("tessellation", "mesh") != "fast":
+        instanced_faces, copy_faces = set_instanced_meshes()
+    generate_surface_mesh(config, geometry_path, instanced_faces)
+    reverse_instanced_faces(copy_faces)
 
     # Write Mesh
     write_surface_meshes(volumes, interfaces, baffles ,step_name, geometry_path)
     if config["snappyHexMeshSetup"].get("edgeMesh", False):
         write_edge_meshes(volumes, interfaces, baffles, geometry_path)
     if config["snappyHexMeshSetup"].get("refinementRegions", False):
-        write_refinement_regions_meshes(volumes, geometry_path)
+        if get_refinement_region_type(config) == "surface":
+            write_refinement_regions_meshes(volumes, geometry_path)
+        elif get_refinement_region_type(config) == "box":
+            for entity in volumes:
+                fit_refinement_boxes(entity, config)
+    if config["snappyHexMeshSetup"].get("checkSurfaces", False):
+        if not check_surface_meshes(get_surface_mesh_files(volumes, interfaces, baffles, step_name, geometry_path, config), config):
+            print("Surface check failed. Check geometry or set checkSurfaces to no to skip the check. Exiting")
+            gmsh.finalize()
+            exit(1)
 
     # Write Dictionaries
     old_dict, new_dict = initialize_sHMD(config)
+    far_field = config["snappyHexMeshSetup"].get("farField")
+    background = None
     if config["snappyHexMeshSetup"].get("generateBlockMeshDict", True):
-        write_block_mesh_dict(model_bounding_box,config["snappyHexMeshSetup"]["backgroundMeshSize"])
+        if far_field:
+            background = write_far_field_block_mesh_dict(model_bounding_box, config["snappyHexMeshSetup"]["backgroundMeshSize"], far_field)
+        else:
+            write_block_mesh_dict(model_bounding_box,config["snappyHexMeshSetup"]["backgroundMeshSize"])
     if not os.path.isfile("./system/meshQualityDict"): # Write base meshMeshQualityDict if one does not exits
         write_mesh_quality_dict()
     configure_sHMD_geometry(new_dict, volumes, interfaces, baffles, step_name, config)
     configure_sHMD_refinement_surfaces(new_dict, old_dict, volumes, interfaces, baffles, step_name, config)
+    if config["snappyHexMeshSetup"].get("autoRefinement"):
+        set_gap_refinement_levels(new_dict, volumes, interfaces, baffles, step_name, config)
     new_dict['castellatedMeshControls']['insidePoints'] = default_volume.inside_points
+    default_region = default_volume.name
+    if background is not None:
+        if far_field.get("meshVolumes", True):
+            new_dict['castellatedMeshControls']['insidePoints'] = default_volume.inside_points + [background["insidePoint"]]
+            print(f"The far field is part of region {default_region}, the volume without a cell zone")
+        else:
+            new_dict['castellatedMeshControls']['insidePoints'] = [background["insidePoint"]]
+            default_region = far_field.get("regionName", "fluid")
     # Edge Mesh
     if config["snappyHexMeshSetup"].get("edgeMesh", False):
         configure_sHMD_feature_edges(new_dict, old_dict, volumes, interfaces, baffles, config)
     # Refinement Regions
     if config["snappyHexMeshSetup"].get("refinementRegions", False):
-        configure_sHMD_refinement_regions(new_dict, old_dict, volumes, config)
+        configure_sHMD_refinement_regions(new_dict, old_dict, volumes, interfaces, baffles, step_name, config)
     # Future layers here
     # createBafflesDict
     if baffles:
@@ -78,6 +122,7 @@ def run_snappy_step(file_name,v,vf):
     # Apply settings from previous sHMD
     if not config['snappyHexMeshSetup'].get('overwriteRefinements', False) and old_dict is not None:
         apply_previous_mesh_settings(new_dict, old_dict, config)
+    estimated_cells = estimate_cell_count(new_dict, volumes, step_name, config, background, default_region)
     write_sHMD(new_dict)
     if baffles:
         for entity in volumes:
@@ -86,7 +131,14 @@ def run_snappy_step(file_name,v,vf):
         write_baffles_script(volumes)
 
     # Write mesh split command
-    write_split_command(default_volume.name)
+    write_split_command(default_region)
+
+    # Parallel decomposition and run script
+    if config["snappyHexMeshSetup"].get("parallel", False):
+        number_of_subdomains = get_number_of_subdomains(estimated_cells, config)
+        if number_of_subdomains > 1:
+            write_decompose_par_dict(number_of_subdomains, config)
+        write_allrun_script(volumes, default_region, number_of_subdomains, background is not None)
     
     # Optionally view mesh
     if v:
@@ -111,9 +163,10 @@ def main_func():
     parser.add_argument('-v', action='store_true',help='Display generated surface mesh after genration') # view generated mesh in gmsh
     parser.add_argument('-vf', action='store_true',help='Display faces and labels. User can choose to continue or stop after inspecting output') # view faces after coherence and don't generate mesh
     parser.add_argument('-file',help='Specify filename if not in constant/(geometry||triSurface) directory or multiple step files are present')
+    parser.add_argument('-list', action='store_true',help='List the STEP assembly tree and entity names and exit')
 
     args = parser.parse_args()
-    run_snappy_step(args.file, args.v,args.vf)
+    run_snappy_step(args.file, args.v,args.vf,args.list)
 
 def snappy_step(file_name = None):
     run_snappy_step(file_name,False,False)
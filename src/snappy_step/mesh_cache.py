@@ -0,0 +1,146 @@
+import os
+import math
+import hashlib
+
+import gmsh
+import numpy as np
+
+CACHE_FILE_NAME = "snappyStepMeshCache.npz"
+CACHE_FORMAT = "snappyStepMeshCache 1" # change when the stored arrays change
+CACHE_ARRAYS = ["coords", "triangles", "boundary"]
+TRIANGLE = 2 # gmsh element type of 3 node triangles
+MESH_SETTINGS = ["meshAlgorithm", "meshSizeFactor", "meshSizeMin", "meshSizeMax", "meshSizeFromCurvature"]
+
+
+def set_mesh_options(config: dict):
+    """ Set the gmsh mesh options from the gmsh dictionary of snappyStepDict """
+    gmsh.option.setNumber("Mesh.Algorithm",config["gmsh"]["meshAlgorithm"])
+    gmsh.option.setNumber("Mesh.MeshSizeFactor",config["gmsh"]["meshSizeFactor"])
+    gmsh.option.setNumber("Mesh.MeshSizeMin",config["gmsh"]["meshSizeMin"])
+    gmsh.option.setNumber("Mesh.MeshSizeMax",config["gmsh"]["meshSizeMax"])
+    gmsh.option.setNumber("Mesh.MeshSizeFromCurvature",config["gmsh"]["meshSizeFromCurvature"])
+
+def get_mesh_settings_key(config: dict) -> str:
+    """ Mesh settings that change the tessellation of a face """
+    return repr([gmsh.GMSH_API_VERSION] + [config["gmsh"].get(key) for key in MESH_SETTINGS])
+
+def get_face_fingerprint(tag: int, settings_key: str) -> str:
+    """ Hash of the face geometry, its boundary curves and the mesh settings """
+    data = [gmsh.model.getType(2, tag), gmsh.model.occ.getMass(2, tag)]
+    data.extend(gmsh.model.occ.getCenterOfMass(2, tag))
+    data.extend(gmsh.model.getBoundingBox(2, tag))
+    curves = gmsh.model.getAdjacencies(2, tag)[1]
+    data.extend(sorted(gmsh.model.occ.getMass(1, curve) for curve in curves))
+    text = settings_key + ",".join(f"{value:.9g}" if isinstance(value, float) else str(value) for value in data)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def read_mesh_cache(cache_path: str) -> dict:
+    """ Cached face meshes by fingerprint, empty if there is no cache file of the current format """
+    if not os.path.isfile(cache_path):
+        return {}
+    try:
+        with np.load(cache_path, allow_pickle=False) as data:
+            if "format" not in data.files or str(data["format"]) != CACHE_FORMAT:
+                print("Surface mesh cache has a different format. Meshing all faces.")
+                return {}
+            fingerprints = {name.rsplit("_", 1)[0] for name in data.files if name != "format"}
+            return {fingerprint: tuple(data[f"{fingerprint}_{array}"] for array in CACHE_ARRAYS) for fingerprint in fingerprints}
+    except Exception:
+        print("Could not read surface mesh cache. Meshing all faces.")
+        return {}
+
+def write_mesh_cache(cache_path: str, cache: dict):
+    """ Replace the cache file with the face meshes of the current model """
+    arrays = {"format": np.array(CACHE_FORMAT)}
+    for fingerprint, mesh in cache.items():
+        arrays.update({f"{fingerprint}_{array}": values for array, values in zip(CACHE_ARRAYS, mesh)})
+    with open(cache_path, "wb") as file:
+        np.savez(file, **arrays)
+
+def get_face_mesh(tag: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Node coordinates, triangles as local node indices and boundary node mask of a meshed face """
+    node_tags, coords, _ = gmsh.model.mesh.getNodes(2, tag, includeBoundary=True)
+    node_tags, first = np.unique(node_tags, return_index=True)
+    coords = np.asarray(coords).reshape(-1, 3)[first]
+    interior_tags, _, _ = gmsh.model.mesh.getNodes(2, tag, includeBoundary=False)
+    boundary = ~np.isin(node_tags, interior_tags)
+    _, element_nodes = gmsh.model.mesh.getElementsByType(TRIANGLE, tag)
+    triangles = np.searchsorted(node_tags, element_nodes).reshape(-1, 3)
+    return coords, triangles, boundary
+
+def get_coordinate_keys(coords: np.ndarray, tolerance: float) -> list[tuple[int, int, int]]:
+    """ Coordinates rounded to the tolerance, used to match nodes between runs """
+    return [tuple(key) for key in np.round(coords/tolerance).astype(np.int64)]
+
+def match_boundary_nodes(tag: int, coords: np.ndarray, boundary: np.ndarray, tolerance: float) -> np.ndarray | None:
+    """ Tags of the current boundary nodes matching the cached boundary nodes, None if the curve mesh changed """
+    node_tags, current_coords, _ = gmsh.model.mesh.getNodes(2, tag, includeBoundary=True)
+    node_tags, first = np.unique(node_tags, return_index=True)
+    if len(node_tags) != boundary.sum():
+        return None
+    current = dict(zip(get_coordinate_keys(np.asarray(current_coords).reshape(-1, 3)[first], tolerance), node_tags))
+    matched = [current.get(key) for key in get_coordinate_keys(coords[boundary], tolerance)]
+    if None in matched:
+        return None
+    return np.array(matched, dtype=np.uint64)
+
+def add_face_mesh(tag: int, coords: np.ndarray, triangles: np.ndarray, boundary: np.ndarray, boundary_tags: np.ndarray):
+    """ Add the interior nodes and triangles of a face mesh, stitched to the existing boundary nodes """
+    interior_count = int((~boundary).sum())
+    start = gmsh.model.mesh.getMaxNodeTag() + 1
+    interior_tags = np.arange(start, start + interior_count, dtype=np.uint64)
+    if interior_count:
+        gmsh.model.mesh.addNodes(2, tag, interior_tags, coords[~boundary].reshape(-1))
+    local_tags = np.zeros(len(coords), dtype=np.uint64)
+    local_tags[boundary] = boundary_tags
+    local_tags[~boundary] = interior_tags
+    gmsh.model.mesh.addElementsByType(tag, TRIANGLE, [], local_tags[triangles].reshape(-1))
+
+def get_match_tolerance() -> float:
+    """ Distance below which nodes of two runs are the same node, relative to the model size """
+    x_min, y_min, z_min, x_max, y_max, z_max = gmsh.model.getBoundingBox(-1, -1)
+    return 1e-9*math.hypot(x_max - x_min, y_max - y_min, z_max - z_min)
+
+def generate_visible_faces(hidden_faces: set[int]):
+    """ Mesh all faces except the hidden ones, whose mesh is added separately """
+    gmsh.option.setNumber("Mesh.MeshOnlyVisible", 1)
+    gmsh.model.setVisibility([(2, tag) for tag in hidden_faces], 0)
+    gmsh.model.mesh.generate(2)
+    gmsh.model.setVisibility([(2, tag) for tag in hidden_faces], 1)
+    gmsh.option.setNumber("Mesh.MeshOnlyVisible", 0)
+
+def generate_cached_surface_mesh(config: dict, cache_directory: str, excluded_faces: set[int] | None = None, mesh_faces=generate_visible_faces):
+    """
+    Mesh the model reusing the cached tessellation of faces whose fingerprint and curve mesh are
+    unchanged. All curves are meshed first, so new and reused faces share the same boundary nodes.
+    Faces with embedded entities and excluded faces are always meshed and never cached.
+    mesh_faces(hidden_faces) meshes the remaining faces.
+    """
+    excluded_faces = excluded_faces or set()
+    cache_path = os.path.join(cache_directory, CACHE_FILE_NAME)
+    cache = read_mesh_cache(cache_path)
+    settings_key = get_mesh_settings_key(config)
+    tolerance = get_match_tolerance()
+
+    gmsh.model.mesh.generate(1)
+    faces = [dim_tag[1] for dim_tag in gmsh.model.getEntities(2)]
+    fingerprints = {}
+    reused = {}
+    for tag in faces:
+        if tag in excluded_faces or gmsh.model.mesh.getEmbedded(2, tag):
+            continue
+        fingerprints[tag] = get_face_fingerprint(tag, settings_key)
+        entry = cache.get(fingerprints[tag])
+        if entry is None:
+            continue
+        boundary_tags = match_boundary_nodes(tag, entry[0], entry[2], tolerance)
+        if boundary_tags is not None:
+            reused[tag] = (entry, boundary_tags)
+    print(f"Reusing cached surface mesh of {len(reused)} of {len(faces)} faces")
+
+    if len(reused) < len(faces):
+        mesh_faces(set(reused))
+    for tag, (entry, boundary_tags) in reused.items():
+        add_face_mesh(tag, entry[0], entry[1], entry[2], boundary_tags)
+
+    write_mesh_cache(cache_path, {fingerprint: get_face_mesh(tag) for tag, fingerprint in fingerprints.items()})
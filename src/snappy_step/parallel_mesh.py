@@ -0,0 +1,128 @@
+import os
+import math
+import heapq
+import tempfile
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import gmsh
+
+from .mesh_cache import (set_mesh_options, get_mesh_settings_key, get_face_fingerprint, get_face_mesh, get_match_tolerance,
+                         match_boundary_nodes, add_face_mesh, generate_visible_faces)
+
+MIN_FACES_PER_PROCESS = 4
+
+
+def get_face_weight(tag: int, config: dict) -> float:
+    """
+    Expected meshing work of a face, proportional to its number of triangles: area/h^2 with h the
+    target element size from meshSizeMax and the curvature at the center of the parametric domain.
+    """
+    settings = config["gmsh"]
+    size = settings["meshSizeMax"]
+    if settings["meshSizeFromCurvature"] > 0:
+        lower, upper = gmsh.model.getParametrizationBounds(2, tag)
+        center = [(low + high)/2.0 for low, high in zip(lower, upper)]
+        try:
+            curvature = abs(gmsh.model.getCurvature(2, tag, center)[0])
+        except Exception:
+            curvature = 0.0
+        if curvature > 0:
+            size = min(size, 2.0*math.pi/(settings["meshSizeFromCurvature"]*curvature))
+    size = max(size*settings["meshSizeFactor"], settings["meshSizeMin"], 1e-12)
+    return gmsh.model.occ.getMass(2, tag)/size**2
+
+def partition_faces(weights: dict[int, float], groups: int) -> list[list[int]]:
+    """ Longest processing time first: heaviest face to the lightest group """
+    heap = [(0.0, index) for index in range(groups)]
+    partition = [[] for _ in range(groups)]
+    for tag in sorted(weights, key=weights.get, reverse=True):
+        load, index = heapq.heappop(heap)
+        partition[index].append(tag)
+        heapq.heappush(heap, (load + weights[tag], index))
+    return [group for group in partition if group]
+
+def mesh_face_group(brep_path: str, config: dict, fingerprints: list[str]) -> dict:
+    """
+    Worker process: import the model, mesh all curves with the same settings as the main process, so
+    curve nodes coincide, and mesh the faces with the given fingerprints. Returns their meshes as
+    (coordinates, triangles, boundary mask) by fingerprint. Faces that fail are left out.
+    """
+    gmsh.initialize()
+    gmsh.option.setNumber("General.Terminal", 0)
+    meshes = {}
+    try:
+        gmsh.model.occ.importShapes(brep_path, False)
+        gmsh.model.occ.synchronize()
+        set_mesh_options(config)
+        gmsh.model.mesh.generate(1)
+        settings_key = get_mesh_settings_key(config)
+        wanted = set(fingerprints)
+        targets = {}
+        for dim_tag in gmsh.model.getEntities(2):
+            fingerprint = get_face_fingerprint(dim_tag[1], settings_key)
+            if fingerprint in wanted:
+                targets[dim_tag[1]] = fingerprint
+        others = {dim_tag[1] for dim_tag in gmsh.model.getEntities(2)} - set(targets)
+        generate_visible_faces(others)
+        for tag, fingerprint in targets.items():
+            mesh = get_face_mesh(tag)
+            if len(mesh[1]):
+                meshes[fingerprint] = mesh
+    except Exception as error:
+        print(f"Surface mesh worker failed: {error}")
+    gmsh.finalize()
+    return meshes
+
+def generate_parallel_surface_mesh(config: dict, serial_faces: set[int] | None = None, hidden_faces: set[int] | None = None):
+    """
+    Mesh the faces of the current model in meshProcesses worker processes. Curves must be meshed.
+    Faces are split into groups of similar work, each worker meshes one group of a BRep copy of the
+    model, and the face meshes are stitched to the curve nodes of this model. Faces with embedded
+    entities, serial faces, faces with the same fingerprint as another face and faces whose mesh does
+    not match the curve nodes are meshed here. Hidden faces are not meshed.
+    """
+    serial_faces = set(serial_faces or set())
+    hidden_faces = set(hidden_faces or set())
+    settings_key = get_mesh_settings_key(config)
+    fingerprints = {}
+    for dim_tag in gmsh.model.getEntities(2):
+        tag = dim_tag[1]
+        if tag in hidden_faces or tag in serial_faces or gmsh.model.mesh.getEmbedded(2, tag):
+            continue
+        fingerprints[tag] = get_face_fingerprint(tag, settings_key)
+    counts = Counter(fingerprints.values())
+    fingerprints = {tag: fingerprint for tag, fingerprint in fingerprints.items() if counts[fingerprint] == 1}
+    processes = min(config["gmsh"].get("meshProcesses", 1), len(fingerprints)//MIN_FACES_PER_PROCESS)
+    if processes < 2:
+        generate_visible_faces(hidden_faces)
+        return
+
+    groups = partition_faces({tag: get_face_weight(tag, config) for tag in fingerprints}, processes)
+    print(f"Meshing {len(fingerprints)} faces with {len(groups)} processes")
+    with tempfile.TemporaryDirectory() as directory:
+        brep_path = os.path.join(directory, "model.brep")
+        gmsh.write(brep_path)
+        group_fingerprints = [[fingerprints[tag] for tag in group] for group in groups]
+        with ProcessPoolExecutor(max_workers=len(groups), mp_context=multiprocessing.get_context("spawn")) as executor:
+            results = list(executor.map(mesh_face_group, [brep_path]*len(groups), [config]*len(groups), group_fingerprints))
+    meshes = {}
+    for result in results:
+        meshes.update(result)
+
+    tolerance = get_match_tolerance()
+    matched = {}
+    for tag, fingerprint in fingerprints.items():
+        mesh = meshes.get(fingerprint)
+        if mesh is None:
+            continue
+        boundary_tags = match_boundary_nodes(tag, mesh[0], mesh[2], tolerance)
+        if boundary_tags is not None:
+            matched[tag] = (mesh, boundary_tags)
+    remaining = len(gmsh.model.getEntities(2)) - len(hidden_faces) - len(matched)
+    print(f"{len(matched)} faces meshed in parallel, {remaining} meshed in the main process")
+    if remaining > 0:
+        generate_visible_faces(hidden_faces | set(matched))
+    for tag, (mesh, boundary_tags) in matched.items():
+        add_face_mesh(tag, mesh[0], mesh[1], mesh[2], boundary_tags)
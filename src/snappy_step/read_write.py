@@ -1,10 +1,12 @@
 import os
+import glob
 import math
 
 import gmsh
 from foamlib import FoamFile, FoamCase
 
 from .geometry import validate_name, Volume, Interface, Baffle
+from .refinement import REFINEMENT_REGION_TYPES
 
 
 def get_geometry_path(): 
@@ -67,7 +69,7 @@ def find_geometry_file(file_name: str, geometry_path: str) -> str:
             print("No step file found in constant/(geometry||triSurface) directory. Exiting.")
             exit(1)
         elif len(files) > 1:
-            print("More than one step file found. Please remove or rename other files, or specify the filepath to read with the -file arguemnt. Exiting.")
+            print("More than one step file found. Please remove or rename other files, list the files to read in the geometryFiles entry, or specify the filepath to read with the -file arguemnt. Exiting.")
             exit(1)   
         else:
             print(files[0]+" found")
@@ -80,6 +82,28 @@ def find_geometry_file(file_name: str, geometry_path: str) -> str:
             exit(1)
     return step_file
 
+def find_geometry_files(file_name: str, geometry_path: str, config: dict) -> list[str]:
+    """
+    Files listed in the geometryFiles entry of snappyStepDict, relative to the geometry directory
+    and possibly glob patterns. Falls back to find_geometry_file if the entry is not present.
+    """
+    patterns = config.get("geometryFiles")
+    if file_name is not None or not patterns:
+        return [find_geometry_file(file_name, geometry_path)]
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    step_files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.join(geometry_path, pattern.strip('"'))))
+        if not matches:
+            print(f"No file matching {pattern} found in {geometry_path}. Exiting.")
+            exit(1)
+        for match in matches:
+            if match not in step_files:
+                step_files.append(match)
+    print(*[os.path.basename(step_file) for step_file in step_files], "found")
+    return step_files
+
 def write_snappy_step_dict_template():
     """
     Write snappy step dictionary template file. 
@@ -114,8 +138,18 @@ def validate_snappy_step_dict(config:dict) -> None:
         if not config['snappyHexMeshSetup'].get('defaultEdgeRefinement', False):
             entries.append('defaultEdgeRefinement')
     if config.get('snappyHexMeshSetup',{}).get('refinementRegions', False):
-        if not config['snappyHexMeshSetup'].get('defaultRegionRefinement', False):
+        region_type = config['snappyHexMeshSetup'].get('refinementRegionType', 'surface')
+        if region_type not in REFINEMENT_REGION_TYPES:
+            print(f"Unknown refinementRegionType {region_type}. Use {', '.join(REFINEMENT_REGION_TYPES)}. Exiting.")
+            exit(1)
+        if region_type == 'distance':
+            if not config['snappyHexMeshSetup'].get('distanceRefinement', False):
+                entries.append('distanceRefinement')
+        elif not config['snappyHexMeshSetup'].get('defaultRegionRefinement', False):
             entries.append('defaultRegionRefinement')
+    if config.get('gmsh',{}).get('tessellation', 'mesh') not in ['mesh', 'fast']:
+        print(f"Unknown tessellation {config['gmsh']['tessellation']}. Use mesh or fast. Exiting.")
+        exit(1)
     if entries:
         print("The following required entry or entries are missing from snappyStepDict:")
         print(*entries)
@@ -172,6 +206,105 @@ def write_block_mesh_dict(bouding_box: list, dx:list[float]):
         if "mergePatchPairs" not in file.as_dict():
             file["mergePatchPairs"] = []
 
+def get_flow_axis(far_field: dict) -> tuple[int, int]:
+    """ Axis index and sign of farField flowDirection, e.g. x or "-z". Negative directions must be quoted in the dictionary. """
+    direction = str(far_field.get("flowDirection", "x")).strip().strip('"')
+    sign = -1 if direction.startswith("-") else 1
+    axis = direction.lstrip("+-").lower()
+    if axis not in ["x", "y", "z"]:
+        print(f"Unknown farField flowDirection {direction}. Use x, y, z, -x, -y or -z. Exiting.")
+        exit(1)
+    return ["x", "y", "z"].index(axis), sign
+
+def get_graded_cells(length: float, first_cell: float, growth_rate: float) -> tuple[int, float]:
+    """
+    Number of cells and expansion ratio (last/first cell) of a block of the given length whose first
+    cell is first_cell and whose cells grow by at most growth_rate from one cell to the next.
+    """
+    if growth_rate <= 1.0 or length <= first_cell:
+        return max(1, round(length/first_cell)), 1.0
+    n = math.ceil(math.log(1.0 + length*(growth_rate - 1.0)/first_cell)/math.log(growth_rate))
+    if n*first_cell >= length:
+        return n, 1.0
+    low, high = 1.0, growth_rate
+    for _ in range(100): # Bisection for the rate that fills the block exactly
+        rate = 0.5*(low + high)
+        if first_cell*(rate**n - 1.0)/(rate - 1.0) > length:
+            high = rate
+        else:
+            low = rate
+    return n, low**(n - 1)
+
+def get_block_face(vertices: list[int], axis: int, high: bool) -> list[int]:
+    """ Face of a hex block normal to the axis, ordered to point out of the block """
+    faces = [[[0, 4, 7, 3], [1, 2, 6, 5]], [[0, 1, 5, 4], [3, 7, 6, 2]], [[0, 3, 2, 1], [4, 5, 6, 7]]]
+    return [vertices[index] for index in faces[axis][high]]
+
+def write_far_field_block_mesh_dict(bouding_box: list, dx: list[float], far_field: dict) -> dict:
+    """
+    Write a blockMeshDict of 3x3x3 blocks around the model. The center block is the uniform background
+    mesh around the model bounding box. The outer blocks reach upstream, downstream and lateral times
+    the largest model dimension and are graded so cells next to the center block keep the background
+    size and grow by growthRate. The upstream and downstream faces are the inlet and outlet patches.
+    Returns the background cell count, the volume of the center block and a point in the far field.
+    """
+    axis, sign = get_flow_axis(far_field)
+    growth_rate = far_field.get("growthRate", 1.2)
+    size = max(bouding_box[3] - bouding_box[0], bouding_box[4] - bouding_box[1], bouding_box[5] - bouding_box[2])
+    lateral = far_field.get("lateral", 5)*size
+    distances = [[lateral, lateral] for _ in range(3)]
+    distances[axis] = [far_field.get("upstream", 5)*size, far_field.get("downstream", 15)*size][::sign]
+    coordinates = []
+    cells = []
+    gradings = []
+    for i in range(3):
+        length = bouding_box[i + 3] - bouding_box[i]
+        n = math.ceil(length/dx[i])
+        buffer = ((n*dx[i]) - length)/2.0
+        low = bouding_box[i] - buffer
+        high = bouding_box[i + 3] + buffer
+        n_low, ratio_low = get_graded_cells(distances[i][0], dx[i], growth_rate)
+        n_high, ratio_high = get_graded_cells(distances[i][1], dx[i], growth_rate)
+        coordinates.append([low - distances[i][0], low, high, high + distances[i][1]])
+        cells.append([n_low, n, n_high])
+        gradings.append([1.0/ratio_low, 1, ratio_high])
+
+    vertices = [[coordinates[0][i], coordinates[1][j], coordinates[2][k]] for k in range(4) for j in range(4) for i in range(4)]
+    blocks = []
+    patches = {"inlet": [], "outlet": []}
+    inlet, outlet = (0, 2) if sign > 0 else (2, 0)
+    for k in range(3):
+        for j in range(3):
+            for i in range(3):
+                corners = [(i, j, k), (i + 1, j, k), (i + 1, j + 1, k), (i, j + 1, k), (i, j, k + 1), (i + 1, j, k + 1), (i + 1, j + 1, k + 1), (i, j + 1, k + 1)]
+                hex_vertices = [a + 4*b + 16*c for a, b, c in corners]
+                blocks.extend(["hex", hex_vertices, [cells[0][i], cells[1][j], cells[2][k]], "simpleGrading", [gradings[0][i], gradings[1][j], gradings[2][k]]])
+                index = (i, j, k)[axis]
+                if index == inlet:
+                    patches["inlet"].append(get_block_face(hex_vertices, axis, False if sign > 0 else True))
+                if index == outlet:
+                    patches["outlet"].append(get_block_face(hex_vertices, axis, True if sign > 0 else False))
+
+    fn = "./system/blockMeshDict"
+    if os.path.isfile(fn):
+        os.remove(fn)
+    case = FoamCase(".")
+    with case.block_mesh_dict as file:
+        file["defaultPatch"]={"name":  "background", "type": "patch"}
+        file["scale"] = 1
+        file["vertices"] = vertices
+        file["blocks"] = blocks
+        file["edges"] = []
+        file["boundary"] = [(name, {"type": "patch", "faces": faces}) for name, faces in patches.items()]
+        file["mergePatchPairs"] = []
+
+    total = sum(cells[0])*sum(cells[1])*sum(cells[2])
+    uniform = math.prod(math.ceil((coordinates[i][3] - coordinates[i][0])/dx[i]) for i in range(3))
+    print(f"Far field background mesh: {total} cells instead of {uniform} uniform cells")
+    inside_point = [(coordinates[i][1] + coordinates[i][2])/2.0 for i in range(3)]
+    inside_point[axis] = (coordinates[axis][inlet] + coordinates[axis][inlet + 1])/2.0
+    return {"cells": total, "coreVolume": math.prod(coordinates[i][2] - coordinates[i][1] for i in range(3)), "insidePoint": inside_point}
+
 def retrive_old_dict_user_entries(old_dict, new_dict):
     """ TODO """
     for key, value in old_dict.items():
@@ -209,11 +342,15 @@ def write_create_baffles_dict(entity: Volume):
     for key in entity.create_baffles_dict:
         file[key] = entity.create_baffles_dict[key]
 
+def get_create_baffles_command(volume: Volume) -> str:
+    """ createBaffles command for the region of the volume """
+    return f"createBaffles -overwrite -region {volume.name} -dict ./system/createBafflesDict_{volume.name}"
+
 def write_baffles_script(volumes: list[Volume]):
     commands = []
     for volume in volumes:
         if volume.baffle_patches:
-            commands.append(f"createBaffles -overwrite -region {volume.name} -dict ./system/createBafflesDict_{volume.name}")
+            commands.append(get_create_baffles_command(volume))
     file_name = "snappyStepCreateBaffles.sh"
     write_commands(file_name,commands)
     os.chmod("./snappyStepCreateBaffles.sh",0o755)
@@ -258,14 +395,81 @@ def check_old_dict(old_dict, key, default_value):
     else:
         return default_value
     
+def get_split_command(default_zone: str) -> str:
+    """ splitMeshRegions command with default_zone as the default region """
+    return "splitMeshRegions -cellZones -defaultRegionName " + default_zone + " -useFaceZones -overwrite"
+
 def write_split_command(default_zone: str):
     """ TODO """
     commands = []
-    commands.append("splitMeshRegions -cellZones -defaultRegionName " + default_zone + " -useFaceZones -overwrite")
+    commands.append(get_split_command(default_zone))
     file_name = "snappyStepSplitMeshRegions.sh"
     write_commands(file_name,commands)
     os.chmod("./snappyStepSplitMeshRegions.sh",0o755)
 
+def get_number_of_subdomains(estimated_cells: int, config: dict) -> int:
+    """ Number of subdomains giving about cellsPerProcessor cells each, limited by maxProcessors """
+    cells_per_processor = config["snappyHexMeshSetup"].get("cellsPerProcessor", 100000)
+    number = max(1, math.ceil(estimated_cells/cells_per_processor))
+    max_processors = config["snappyHexMeshSetup"].get("maxProcessors")
+    if max_processors is not None:
+        number = min(number, max_processors)
+    print(f"Decomposing into {number} subdomains")
+    return number
+
+def write_decompose_par_dict(number_of_subdomains: int, config: dict):
+    """ Write system/decomposeParDict """
+    fn = "./system/decomposeParDict"
+    if os.path.isfile(fn):
+        os.remove(fn)
+    file = FoamFile(fn)
+    file["numberOfSubdomains"] = number_of_subdomains
+    file["method"] = config["snappyHexMeshSetup"].get("decompositionMethod", "scotch")
+
+def get_concurrent_commands(commands: list[str], jobs: int) -> list[str]:
+    """ Shell lines running the commands in the background, at most jobs at a time, and exiting if any of them fails """
+    lines = []
+    for start in range(0, len(commands), max(1, jobs)):
+        batch = commands[start:start + max(1, jobs)]
+        if len(batch) == 1:
+            lines.append(batch[0] + " || exit 1")
+            continue
+        lines.append('pids=""')
+        for command in batch:
+            lines.append(command + " &")
+            lines.append('pids="$pids $!"')
+        lines.append("for pid in $pids; do wait $pid || exit 1; done")
+    return lines
+
+def write_allrun_script(volumes: list[Volume], default_zone: str, number_of_subdomains: int, far_field: bool = False):
+    """
+    Write snappyStepAllrun.sh running blockMesh, decomposePar, snappyHexMesh and the region split in
+    parallel. With a single subdomain the same steps run in serial. The split also runs for a single
+    volume in a far field. The regions are then reconstructed and createBaffles runs for all regions
+    with baffles concurrently, in serial, at most number_of_subdomains at a time.
+    """
+    if number_of_subdomains > 1:
+        prefix = f"mpirun -np {number_of_subdomains} "
+        suffix = " -parallel"
+    else:
+        prefix = ""
+        suffix = ""
+    commands = ["#!/bin/sh", 'cd "${0%/*}" || exit 1']
+    commands.append("blockMesh > log.blockMesh 2>&1 || exit 1")
+    if number_of_subdomains > 1:
+        commands.append("decomposePar -force > log.decomposePar 2>&1 || exit 1")
+    commands.append(prefix + "snappyHexMesh" + suffix + " -overwrite > log.snappyHexMesh 2>&1 || exit 1")
+    if len(volumes) > 1 or far_field:
+        commands.append(prefix + get_split_command(default_zone) + suffix + " > log.splitMeshRegions 2>&1 || exit 1")
+    baffle_commands = [get_create_baffles_command(volume) + f" > log.createBaffles.{volume.name} 2>&1" for volume in volumes if volume.baffle_patches]
+    if baffle_commands and number_of_subdomains > 1:
+        commands.append("reconstructPar -allRegions -constant > log.reconstructPar 2>&1 || exit 1")
+    commands.extend(get_concurrent_commands(baffle_commands, number_of_subdomains))
+    commands.append("")
+    file_name = "snappyStepAllrun.sh"
+    write_commands(file_name,commands)
+    os.chmod("./snappyStepAllrun.sh",0o755)
+
 def write_commands(file_name: str, commands: list):
     """ TODO """
     with open(file_name, 'w') as script:
@@ -296,6 +500,16 @@ def write_surface_meshes(volumes: list[Volume],interfaces: list[Interface], baff
     gmsh.model.removePhysicalGroups([])
 
 
+def get_surface_mesh_files(volumes: list[Volume], interfaces: list[Interface], baffles: list[Baffle], step_name, path, config: dict) -> list[str]:
+    """ Paths of the STL files written by write_surface_meshes and write_refinement_regions_meshes """
+    file_paths = [os.path.join(path,step_name+".stl")]
+    for instance in interfaces + baffles:
+        file_paths.append(os.path.join(path,instance.name+".stl"))
+    if config["snappyHexMeshSetup"].get("refinementRegions", False) and config["snappyHexMeshSetup"].get("refinementRegionType", "surface") == "surface":
+        for instance in volumes:
+            file_paths.append(os.path.join(path,instance.name+"_refinement_region.stl"))
+    return file_paths
+
 def write_refinement_regions_meshes(volumes: list[Volume], path):
     gmsh.model.removePhysicalGroups([])
     for instance in volumes:
@@ -341,8 +555,12 @@ def configure_sHMD_geometry(new_dict: dict, volumes: list[Volume], interfaces: l
     for instance in baffles:
         new_dict["geometry"][instance.name] = {"type":"triSurfaceMesh",'file':f'"{instance.name}.stl"'}
     if config["snappyHexMeshSetup"].get("refinementRegions", False):
+        region_type = config["snappyHexMeshSetup"].get("refinementRegionType", "surface")
         for instance in volumes:
-            new_dict["geometry"][instance.name+'_refinement_region'] = {"type":"triSurfaceMesh",'file':f'"{instance.name}_refinement_region.stl"'}
+            if region_type == "surface":
+                new_dict["geometry"][instance.name+'_refinement_region'] = {"type":"triSurfaceMesh",'file':f'"{instance.name}_refinement_region.stl"'}
+            elif region_type == "box":
+                new_dict["geometry"].update(instance.refinement_geometry)
     
  
 def configure_sHMD_refinement_surfaces(new_dict: dict, old_dict: dict, volumes: list[Volume], interfaces: list[Interface], baffles: list[Baffle], step_name: str, config: dict):
@@ -376,11 +594,22 @@ def configure_sHMD_refinement_surfaces(new_dict: dict, old_dict: dict, volumes:
             new_dict["castellatedMeshControls"]["refinementSurfaces"][instance.name]["mode"] = "insidePoint"
             new_dict["castellatedMeshControls"]["refinementSurfaces"][instance.name]["insidePoint"] = instance.inside_point
 
-def configure_sHMD_refinement_regions(new_dict: dict, old_dict: dict, volumes: list[Volume], config: dict):
+def configure_sHMD_refinement_regions(new_dict: dict, old_dict: dict, volumes: list[Volume], interfaces: list[Interface], baffles: list[Baffle], step_name: str, config: dict):
     new_dict["castellatedMeshControls"]["refinementRegions"] = {}
+    region_type = config["snappyHexMeshSetup"].get("refinementRegionType", "surface")
+    if region_type == "distance":
+        # Distance mode refines around the existing surfaces, no extra geometry is needed
+        level = config["snappyHexMeshSetup"]["distanceRefinement"]
+        for name in [step_name] + [instance.name for instance in interfaces + baffles]:
+            new_dict["castellatedMeshControls"]["refinementRegions"][name] = {"mode": "distance", "levels": level}
+        return
     for instance in volumes:
         level = config["snappyHexMeshSetup"]["defaultRegionRefinement"]
-        new_dict["castellatedMeshControls"]["refinementRegions"][instance.name+"_refinement_region"] = {"mode": "inside", "levels": level}
+        if region_type == "box":
+            for name in instance.refinement_geometry:
+                new_dict["castellatedMeshControls"]["refinementRegions"][name] = {"mode": "inside", "levels": level}
+        else:
+            new_dict["castellatedMeshControls"]["refinementRegions"][instance.name+"_refinement_region"] = {"mode": "inside", "levels": level}
 
 def configure_sHMD_feature_edges(new_dict: dict, old_dict: dict, volumes: list[Volume], interfaces: list[Interface], baffles: list[Baffle], config: dict):
     """ TODO """
@@ -0,0 +1,250 @@
+import math
+
+import gmsh
+import numpy as np
+
+from .geometry import Volume, Interface, Baffle
+from .mesh_cache import get_face_mesh
+from .surface_check import segments_cross_triangles
+
+REFINEMENT_REGION_TYPES = ["surface", "box", "distance"]
+DEFAULT_BOX_DIVISIONS = 4
+DEFAULT_MAX_BOXES = 8
+DEFAULT_CELLS_ACROSS_GAP = 3
+DEFAULT_GAP_CONE_ANGLE = 30 # degrees
+GAP_RAY_STEPS = 16 # minimum hash cell is the search radius divided by this
+GAP_BATCH_PAIRS = 1000000 # triangle pairs tested at once
+
+
+def get_refinement_region_type(config: dict) -> str:
+    """ How refinement regions are defined: surface (closed STL per volume), box or distance """
+    return config["snappyHexMeshSetup"].get("refinementRegionType", "surface")
+
+def get_volume_surface_nodes(entity: Volume) -> np.ndarray:
+    """ Coordinates of the surface mesh nodes on the boundary of the volume """
+    coords = []
+    for tag in entity.exterior_tags + entity.interface_tags:
+        coords.append(np.asarray(gmsh.model.mesh.getNodes(2, tag, includeBoundary=True)[1]).reshape(-1, 3))
+    return np.concatenate(coords)
+
+def get_oriented_frame(points: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Tight box around the points as (corner, axes, span) with the axes as rows. The principal axes
+    of the points are used unless the axis aligned box is smaller.
+    """
+    eigenvectors = np.linalg.eigh(np.cov(points.T))[1].T[::-1]
+    eigenvectors[2] = np.cross(eigenvectors[0], eigenvectors[1]) # right handed
+    best = None
+    for axes in [eigenvectors, np.eye(3)]:
+        local = points @ axes.T
+        lower = local.min(axis=0)
+        span = local.max(axis=0) - lower
+        if best is None or np.prod(span) < np.prod(best[2]):
+            best = (lower @ axes, axes, span)
+    return best
+
+def get_occupancy(entity: Volume, corner: np.ndarray, axes: np.ndarray, span: np.ndarray, divisions: int, points: np.ndarray) -> np.ndarray:
+    """ Cells of a divisions^3 grid over the box containing a surface node or with the cell center inside the volume """
+    cell = span/divisions
+    occupied = np.zeros((divisions, divisions, divisions), dtype=bool)
+    safe_cell = np.where(cell > 0, cell, 1.0)
+    index = np.clip(np.floor(((points - corner) @ axes.T)/safe_cell).astype(int), 0, divisions - 1)
+    occupied[index[:, 0], index[:, 1], index[:, 2]] = True
+    for i, j, k in np.argwhere(~occupied):
+        center = corner + (np.array([i, j, k]) + 0.5)*cell @ axes
+        if any(gmsh.model.isInside(3, tag, list(center)) for tag in entity._tags):
+            occupied[i, j, k] = True
+    return occupied
+
+def merge_occupied_cells(occupied: np.ndarray) -> list[tuple[np.ndarray, np.ndarray]]:
+    """ Greedily merge occupied grid cells into boxes, as (lower, upper) cell indices """
+    remaining = occupied.copy()
+    n = remaining.shape
+    boxes = []
+    for i, j, k in np.argwhere(occupied):
+        if not remaining[i, j, k]:
+            continue
+        i_end = i + 1
+        while i_end < n[0] and remaining[i_end, j, k]:
+            i_end += 1
+        j_end = j + 1
+        while j_end < n[1] and remaining[i:i_end, j_end, k].all():
+            j_end += 1
+        k_end = k + 1
+        while k_end < n[2] and remaining[i:i_end, j:j_end, k_end].all():
+            k_end += 1
+        remaining[i:i_end, j:j_end, k:k_end] = False
+        boxes.append((np.array([i, j, k]), np.array([i_end, j_end, k_end])))
+    return boxes
+
+def get_box_geometry(corner: np.ndarray, axes: np.ndarray, span: np.ndarray) -> dict:
+    """ searchableBox if the box is axis aligned, searchableRotatedBox otherwise """
+    if np.allclose(axes, np.eye(3)):
+        return {"type": "searchableBox", "min": list(map(float, corner)), "max": list(map(float, corner + span))}
+    return {"type": "searchableRotatedBox", "span": list(map(float, span)), "origin": list(map(float, corner)),
+            "e1": list(map(float, axes[0])), "e3": list(map(float, axes[2]))}
+
+def fit_refinement_boxes(entity: Volume, config: dict):
+    """
+    Fit an oriented box, or a union of boxes for volumes that fill their box poorly, to the volume
+    and store them as snappyHexMesh geometry entries in entity.refinement_geometry.
+    """
+    divisions = config["snappyHexMeshSetup"].get("refinementBoxDivisions", DEFAULT_BOX_DIVISIONS)
+    max_boxes = config["snappyHexMeshSetup"].get("maxRefinementBoxes", DEFAULT_MAX_BOXES)
+    points = get_volume_surface_nodes(entity)
+    corner, axes, span = get_oriented_frame(points)
+    boxes = merge_occupied_cells(get_occupancy(entity, corner, axes, span, divisions, points))
+    name = entity.name + "_refinement_region"
+    entity.refinement_geometry = {}
+    if len(boxes) <= 1 or len(boxes) > max_boxes:
+        entity.refinement_geometry[name] = get_box_geometry(corner, axes, span)
+        return
+    cell = span/divisions
+    for index, (lower, upper) in enumerate(boxes):
+        entity.refinement_geometry[f"{name}_{index}"] = get_box_geometry(corner + (lower*cell) @ axes, axes, (upper - lower)*cell)
+    print(f"{entity.name} refinement region is a union of {len(boxes)} boxes")
+
+def get_face_triangles(tags: list[int]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Corners as (n, 3, 3), unit normals and face tags of the surface mesh triangles of the faces """
+    corners = []
+    normals = []
+    owners = []
+    for tag in tags:
+        coords, triangles, _ = get_face_mesh(tag)
+        face_corners = coords[triangles]
+        if len(face_corners) == 0:
+            continue
+        normal = np.cross(face_corners[:, 1] - face_corners[:, 0], face_corners[:, 2] - face_corners[:, 0])
+        length = np.linalg.norm(normal, axis=1)
+        valid = length > 0
+        corners.append(face_corners[valid])
+        normals.append(normal[valid]/length[valid, None])
+        owners.append(np.full(valid.sum(), tag))
+    if not corners:
+        return np.zeros((0, 3, 3)), np.zeros((0, 3)), np.zeros(0, dtype=int)
+    return np.concatenate(corners), np.concatenate(normals), np.concatenate(owners)
+
+def point_triangle_distance(points: np.ndarray, triangles: np.ndarray) -> np.ndarray:
+    """ Distance from each point to the closest point of the triangle in the same row """
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    normal = np.cross(b - a, c - a)
+    normal /= np.linalg.norm(normal, axis=1)[:, None]
+    height = np.einsum("ij,ij->i", points - a, normal)
+    projected = points - height[:, None]*normal
+    inside = np.ones(len(points), dtype=bool)
+    for start, end in [(a, b), (b, c), (c, a)]:
+        inside &= np.einsum("ij,ij->i", np.cross(end - start, projected - start), normal) >= 0
+    distance = np.where(inside, np.abs(height), np.inf)
+    for start, end in [(a, b), (b, c), (c, a)]:
+        edge = end - start
+        t = np.clip(np.einsum("ij,ij->i", points - start, edge)/np.einsum("ij,ij->i", edge, edge), 0.0, 1.0)
+        distance = np.minimum(distance, np.linalg.norm(points - start - t[:, None]*edge, axis=1))
+    return distance
+
+def get_triangle_hash(triangles: np.ndarray, cell: float, margin: float) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Uniform spatial hash of the triangle bounding boxes grown by margin. Returns the origin and
+    dimensions of the grid and the sorted cell keys with the triangle index of every entry.
+    """
+    lower = triangles.min(axis=1) - margin
+    upper = triangles.max(axis=1) + margin
+    origin = lower.min(axis=0)
+    cell_lower = np.floor((lower - origin)/cell).astype(np.int64)
+    spans = np.floor((upper - origin)/cell).astype(np.int64) - cell_lower + 1
+    dims = np.floor((upper.max(axis=0) - origin)/cell).astype(np.int64) + 1
+    counts = spans.prod(axis=1)
+    triangle_index = np.repeat(np.arange(len(triangles)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    span_x = spans[triangle_index, 0]
+    span_y = spans[triangle_index, 1]
+    cells = cell_lower[triangle_index] + np.stack([local % span_x, (local//span_x) % span_y, local//(span_x*span_y)], axis=1)
+    keys = cells[:, 0] + dims[0]*(cells[:, 1] + dims[1]*cells[:, 2])
+    order = np.argsort(keys, kind="stable")
+    return origin, dims, keys[order], triangle_index[order]
+
+def get_local_gaps(triangles: np.ndarray, normals: np.ndarray, radius: float, cone_angle: float) -> np.ndarray:
+    """
+    Distance from the centroid of every triangle to the closest point of the first triangles hit by
+    a ray along its normal, in both directions, inf if there is none within radius. Only triangles
+    within cone_angle of parallel count, which excludes neighbours on the same surface. Candidates
+    are found by sampling the rays through a spatial hash of the triangles, in batches of at most
+    GAP_BATCH_PAIRS triangle pairs.
+    """
+    gaps = np.full(len(triangles), np.inf)
+    if len(triangles) == 0:
+        return gaps
+    cos_cone = math.cos(math.radians(cone_angle))
+    centroids = triangles.mean(axis=1)
+    extent = (triangles.max(axis=1) - triangles.min(axis=1)).max(axis=1)
+    cell = max(np.median(extent), radius/GAP_RAY_STEPS, extent.max()/64.0, 1e-12)
+    step = cell/2.0
+    origin, dims, sorted_keys, hashed = get_triangle_hash(triangles, cell, step)
+    for sign in [1.0, -1.0]:
+        for index in range(math.ceil(radius/step) + 1):
+            # Triangles first found at this sample are hit at least (index - 1/2)*step along the ray
+            active = np.flatnonzero(gaps > max(index - 1, 0)*step*cos_cone)
+            samples = centroids[active] + sign*index*step*normals[active]
+            cells = np.floor((samples - origin)/cell).astype(np.int64)
+            inside = ((cells >= 0) & (cells < dims)).all(axis=1)
+            active = active[inside]
+            cells = cells[inside]
+            keys = cells[:, 0] + dims[0]*(cells[:, 1] + dims[1]*cells[:, 2])
+            first = np.searchsorted(sorted_keys, keys, side="left")
+            counts = np.searchsorted(sorted_keys, keys, side="right") - first
+            cumulative = np.cumsum(counts)
+            batch_start = 0
+            while batch_start < len(active):
+                batch_end = max(int(np.searchsorted(cumulative, cumulative[batch_start] - counts[batch_start] + GAP_BATCH_PAIRS, side="right")), batch_start + 1)
+                batch = slice(batch_start, batch_end)
+                batch_start = batch_end
+                batch_counts = counts[batch]
+                if batch_counts.sum() == 0:
+                    continue
+                source = np.repeat(active[batch], batch_counts)
+                local = np.arange(batch_counts.sum()) - np.repeat(np.cumsum(batch_counts) - batch_counts, batch_counts)
+                target = hashed[np.repeat(first[batch], batch_counts) + local]
+                keep = (target != source) & (np.abs(np.einsum("ij,ij->i", normals[source], normals[target])) >= cos_cone)
+                source = source[keep]
+                target = target[keep]
+                hit = segments_cross_triangles(centroids[source], centroids[source] + sign*radius*normals[source], triangles[target])
+                source = source[hit]
+                distance = point_triangle_distance(centroids[source], triangles[target[hit]])
+                close = (distance > 0) & (distance <= radius)
+                np.minimum.at(gaps, source[close], distance[close])
+    return gaps
+
+def set_gap_refinement_levels(new_dict: dict, volumes: list[Volume], interfaces: list[Interface], baffles: list[Baffle], step_name: str, config: dict):
+    """
+    Replace the default surface refinement level of every patch, interface and baffle with the lowest
+    level that puts cellsAcrossGap cells across the narrowest gap or wall measured on its surface
+    mesh, limited to minLevel and maxLevel.
+    """
+    settings = config["snappyHexMeshSetup"]["autoRefinement"]
+    cells_across = settings.get("cellsAcrossGap", DEFAULT_CELLS_ACROSS_GAP)
+    min_level = settings.get("minLevel", 0)
+    max_level = settings.get("maxLevel", max(config["snappyHexMeshSetup"]["defaultSurfaceRefinement"]))
+    dx = max(config["snappyHexMeshSetup"]["backgroundMeshSize"])
+    print("Measuring gaps for surface refinement levels")
+    tags = sorted({dim_tag[1] for dim_tag in gmsh.model.getEntities(2)})
+    triangles, normals, owners = get_face_triangles(tags)
+    gaps = get_local_gaps(triangles, normals, cells_across*dx/2**min_level, settings.get("coneAngle", DEFAULT_GAP_CONE_ANGLE))
+    face_gaps = {tag: np.inf for tag in tags}
+    for tag, gap in zip(owners, gaps):
+        face_gaps[tag] = min(face_gaps[tag], gap)
+
+    def get_level(face_tags: list[int]) -> tuple[float, int]:
+        gap = min([face_gaps.get(tag, np.inf) for tag in face_tags] + [np.inf])
+        if not np.isfinite(gap):
+            return gap, min_level
+        return gap, min(max(math.ceil(math.log2(cells_across*dx/gap)), min_level), max_level)
+
+    surfaces = new_dict["castellatedMeshControls"]["refinementSurfaces"]
+    patch_tags = {}
+    for entity in volumes:
+        for patch, face_tags in entity.exterior_patches.items():
+            patch_tags.setdefault(patch, []).extend(face_tags)
+    levels = [(patch, surfaces[step_name]["regions"][patch], get_level(face_tags)) for patch, face_tags in patch_tags.items()]
+    levels.extend((instance.name, surfaces[instance.name], get_level(instance.face_tags)) for instance in interfaces + baffles)
+    for name, entry, (gap, level) in levels:
+        entry["level"] = [level, level]
+        print(f"    {name}: " + (f"minimum gap {gap:.3g}" if np.isfinite(gap) else "no gap found") + f", level {level}")
@@ -0,0 +1,242 @@
+import os
+
+import numpy as np
+
+STL_RECORD = np.dtype([("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attribute", "<u2")])
+WELD_TOLERANCE = 1e-9 # Relative to the bounding box diagonal
+DEFAULT_SLIVER_QUALITY = 1e-3
+
+
+def is_binary_stl(file_path: str) -> bool:
+    """ Binary STL if the triangle counts in the headers add up to the file size """
+    size = os.path.getsize(file_path)
+    with open(file_path, "rb") as file:
+        offset = 0
+        while offset + 84 <= size:
+            file.seek(offset + 80)
+            count = int(np.frombuffer(file.read(4), "<u4")[0])
+            offset += 84 + 50*count
+        return offset == size and size > 0
+
+def read_binary_stl(file_path: str) -> dict[str, np.ndarray]:
+    """ Memory map the triangles of a binary STL. Concatenated solids are read one after another. """
+    solids = {}
+    size = os.path.getsize(file_path)
+    offset = 0
+    with open(file_path, "rb") as file:
+        while offset + 84 <= size:
+            file.seek(offset)
+            header = file.read(80).decode("ascii", errors="replace").strip("\x00 ")
+            count = int(np.frombuffer(file.read(4), "<u4")[0])
+            name = header.removeprefix("solid").strip() or f"solid{len(solids)}"
+            records = np.memmap(file_path, dtype=STL_RECORD, mode="r", offset=offset + 84, shape=(count,)) if count else np.zeros(0, STL_RECORD)
+            solids[name] = records["vertices"]
+            offset += 84 + 50*count
+    return solids
+
+def read_ascii_stl(file_path: str) -> dict[str, np.ndarray]:
+    """ Triangles of every solid in an ASCII STL """
+    solids = {}
+    name = ""
+    coordinates = []
+    with open(file_path) as file:
+        for line in file:
+            words = line.split()
+            if not words:
+                continue
+            if words[0] == "vertex":
+                coordinates.append(words[1:4])
+            elif words[0] == "solid":
+                name = " ".join(words[1:])
+                coordinates = []
+            elif words[0] == "endsolid":
+                solids[name] = np.array(coordinates, dtype=float).reshape(-1, 3, 3)
+    return solids
+
+def read_stl(file_path: str) -> dict[str, np.ndarray]:
+    """ Triangles of each solid in an STL file as (n, 3, 3) arrays """
+    if is_binary_stl(file_path):
+        return read_binary_stl(file_path)
+    return read_ascii_stl(file_path)
+
+def weld_vertices(triangles: np.ndarray, tolerance: float) -> tuple[np.ndarray, np.ndarray]:
+    """ Merge coincident vertices. Returns unique points and (n, 3) vertex ids per triangle. """
+    keys = np.round(triangles.reshape(-1, 3)/tolerance).astype(np.int64)
+    _, first, ids = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    points = triangles.reshape(-1, 3)[first].astype(float)
+    return points, ids.reshape(-1, 3)
+
+def get_edge_counts(ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ Number of triangles and sum of directions (+1 low to high id, -1 otherwise) of each undirected edge """
+    start = ids.reshape(-1)
+    end = ids[:, [1, 2, 0]].reshape(-1)
+    low = np.minimum(start, end)
+    high = np.maximum(start, end)
+    direction = np.where(start < end, 1, -1)
+    _, inverse, counts = np.unique(np.stack([low, high], axis=1), axis=0, return_inverse=True, return_counts=True)
+    direction_sum = np.bincount(inverse.reshape(-1), weights=direction, minlength=len(counts))
+    return counts, direction_sum
+
+def get_candidate_pairs(triangles: np.ndarray) -> np.ndarray:
+    """ Pairs of triangles sharing a cell of a uniform spatial hash of their bounding boxes """
+    n = len(triangles)
+    lower = triangles.min(axis=1)
+    upper = triangles.max(axis=1)
+    extent = (upper - lower).max(axis=1)
+    cell = max(np.median(extent), extent.max()/32.0, 1e-12)
+    origin = lower.min(axis=0)
+    cell_lower = np.floor((lower - origin)/cell).astype(np.int64)
+    spans = np.floor((upper - origin)/cell).astype(np.int64) - cell_lower + 1
+    counts = spans.prod(axis=1)
+    triangle_index = np.repeat(np.arange(n), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    span_x = spans[triangle_index, 0]
+    span_y = spans[triangle_index, 1]
+    cells = cell_lower[triangle_index] + np.stack([local % span_x, (local//span_x) % span_y, local//(span_x*span_y)], axis=1)
+    dims = cells.max(axis=0) + 1
+    keys = cells[:, 0] + dims[0]*(cells[:, 1] + dims[1]*cells[:, 2])
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    triangle_index = triangle_index[order]
+    pairs = []
+    offset = 1
+    while offset < len(keys):
+        same = keys[offset:] == keys[:-offset]
+        if not same.any():
+            break
+        pairs.append(np.stack([triangle_index[:-offset][same], triangle_index[offset:][same]], axis=1))
+        offset += 1
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    return np.unique(pairs, axis=0)
+
+def segments_cross_triangles(start: np.ndarray, end: np.ndarray, triangles: np.ndarray, eps: float = 1e-9) -> np.ndarray:
+    """ Möller-Trumbore test of segments against triangles, pairwise. Touching contacts do not count. """
+    direction = end - start
+    edge_1 = triangles[:, 1] - triangles[:, 0]
+    edge_2 = triangles[:, 2] - triangles[:, 0]
+    h = np.cross(direction, edge_2)
+    a = np.einsum("ij,ij->i", edge_1, h)
+    scale = np.linalg.norm(direction, axis=1)*np.linalg.norm(edge_1, axis=1)*np.linalg.norm(edge_2, axis=1)
+    valid = np.abs(a) > 1e-12*scale
+    f = np.divide(1.0, a, out=np.zeros_like(a), where=valid)
+    s = start - triangles[:, 0]
+    u = f*np.einsum("ij,ij->i", s, h)
+    q = np.cross(s, edge_1)
+    v = f*np.einsum("ij,ij->i", direction, q)
+    t = f*np.einsum("ij,ij->i", edge_2, q)
+    return valid & (u > eps) & (v > eps) & (u + v < 1 - eps) & (t > eps) & (t < 1 - eps)
+
+def count_self_intersections(points: np.ndarray, ids: np.ndarray) -> int:
+    """ Number of triangle pairs without a shared vertex where an edge of one crosses the other """
+    triangles = points[ids]
+    pairs = get_candidate_pairs(triangles)
+    if len(pairs) == 0:
+        return 0
+    shared = (ids[pairs[:, 0]][:, :, None] == ids[pairs[:, 1]][:, None, :]).any(axis=(1, 2))
+    pairs = pairs[~shared]
+    lower = triangles.min(axis=1)
+    upper = triangles.max(axis=1)
+    overlap = ((lower[pairs[:, 0]] <= upper[pairs[:, 1]]) & (lower[pairs[:, 1]] <= upper[pairs[:, 0]])).all(axis=1)
+    pairs = pairs[overlap]
+    intersecting = np.zeros(len(pairs), dtype=bool)
+    for first, second in [(0, 1), (1, 0)]:
+        edges = triangles[pairs[:, first]]
+        others = triangles[pairs[:, second]]
+        for corner in range(3):
+            intersecting |= segments_cross_triangles(edges[:, corner], edges[:, (corner + 1) % 3], others)
+    return int(intersecting.sum())
+
+def check_stl_file(file_path: str, closed: bool, sliver_quality: float) -> tuple[list[str], list[str]]:
+    """
+    Check one STL file. Returns lists of errors and warnings. Zero-area triangles and self-intersections
+    are always errors. Open or non-manifold solids are errors if closed is set. Duplicate triangles are
+    warnings, since baffle surfaces are written once for each side.
+    """
+    errors = []
+    warnings = []
+    solids = read_stl(file_path)
+    triangles = np.concatenate([np.asarray(solid, dtype=float) for solid in solids.values()]) if solids else np.zeros((0, 3, 3))
+    if len(triangles) == 0:
+        errors.append("no triangles")
+        return errors, warnings
+    diagonal = np.linalg.norm(triangles.reshape(-1, 3).max(axis=0) - triangles.reshape(-1, 3).min(axis=0))
+    points, ids = weld_vertices(triangles, WELD_TOLERANCE*diagonal)
+
+    # Degenerate triangles
+    corners = points[ids]
+    area = 0.5*np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
+    squared_edges = sum(np.sum((corners[:, i] - corners[:, (i + 1) % 3])**2, axis=1) for i in range(3))
+    quality = np.divide(4.0*np.sqrt(3.0)*area, squared_edges, out=np.zeros_like(area), where=squared_edges > 0)
+    zero_area = (area <= (WELD_TOLERANCE*diagonal)**2) | (ids[:, 0] == ids[:, 1]) | (ids[:, 1] == ids[:, 2]) | (ids[:, 2] == ids[:, 0])
+    if zero_area.any():
+        errors.append(f"{zero_area.sum()} zero-area triangles")
+    slivers = ~zero_area & (quality < sliver_quality)
+    if slivers.any():
+        warnings.append(f"{slivers.sum()} sliver triangles (quality < {sliver_quality:g})")
+    solid_index = np.repeat(np.arange(len(solids)), [len(solid) for solid in solids.values()])[~zero_area]
+    ids = ids[~zero_area]
+    if len(ids) == 0:
+        return errors, warnings
+
+    # Duplicate triangles
+    _, counts = np.unique(np.sort(ids, axis=1), axis=0, return_counts=True)
+    duplicates = int((counts - 1).sum())
+    if duplicates:
+        warnings.append(f"{duplicates} duplicate triangles")
+
+    # Edges, closedness and orientation
+    counts, direction_sum = get_edge_counts(ids)
+    non_manifold = int((counts > 2).sum())
+    flipped = int(((counts == 2) & (direction_sum != 0)).sum())
+    if flipped:
+        warnings.append(f"{flipped} edges between triangles with opposite normals")
+    if closed:
+        for index, name in enumerate(solids):
+            solid_ids = ids[solid_index == index]
+            if len(solid_ids) == 0:
+                continue
+            solid_counts, _ = get_edge_counts(solid_ids)
+            open_edges = int((solid_counts == 1).sum())
+            if open_edges:
+                errors.append(f"solid {name} is not closed, {open_edges} open edges")
+    if non_manifold:
+        message = f"{non_manifold} non-manifold edges"
+        if closed:
+            errors.append(message)
+        else:
+            warnings.append(message)
+    if closed and not flipped and not non_manifold:
+        signed_volume = np.einsum("ij,ij->i", points[ids[:, 0]], np.cross(points[ids[:, 1]], points[ids[:, 2]])).sum()/6.0
+        if signed_volume < 0:
+            warnings.append("normals point inwards")
+
+    # Self intersections
+    intersections = count_self_intersections(points, ids)
+    if intersections:
+        errors.append(f"{intersections} self-intersecting triangle pairs")
+    return errors, warnings
+
+def check_surface_meshes(file_paths: list[str], config: dict) -> bool:
+    """
+    Check the generated STL files before snappyHexMesh runs and print a report per file.
+    Refinement region files must be closed. Returns False if any file has errors.
+    """
+    print("Checking surface meshes")
+    sliver_quality = config["snappyHexMeshSetup"].get("sliverQuality", DEFAULT_SLIVER_QUALITY)
+    passed = True
+    for file_path in file_paths:
+        closed = file_path.endswith("_refinement_region.stl")
+        errors, warnings = check_stl_file(file_path, closed, sliver_quality)
+        name = os.path.basename(file_path)
+        if errors:
+            passed = False
+            print(f"    {name}: FAILED")
+        else:
+            print(f"    {name}: OK")
+        for error in errors:
+            print(f"        Error: {error}")
+        for warning in warnings:
+            print(f"        Warning: {warning}")
+    return passed
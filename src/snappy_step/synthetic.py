@@ -0,0 +1,201 @@
+import os
+import re
+import time
+import argparse
+import multiprocessing
+from contextlib import chdir
+from concurrent.futures import ProcessPoolExecutor
+
+import gmsh
+from foamlib import FoamFile
+
+from .geometry import *
+from .read_write import *
+
+ASSEMBLY_KINDS = ["cubes", "baffles", "bodies"]
+
+
+def add_touching_cubes(n: int, size: float = 1.0) -> list[tuple[int, int, str]]:
+    """ n x n x n cubes sharing faces, each cube its own region """
+    names = []
+    for i in range(n):
+        for j in range(n):
+            for k in range(n):
+                names.append((3, gmsh.model.occ.addBox(i*size, j*size, k*size, size, size, size), f"cube_{i}_{j}_{k}"))
+    return names
+
+def add_plate_with_baffles(m: int, size: float = 1.0) -> list[tuple[int, int, str]]:
+    """ A block with m baffle surfaces embedded at equally spaced heights """
+    names = [(3, gmsh.model.occ.addBox(0, 0, 0, size, size, size), "plate")]
+    for index in range(m):
+        names.append((2, gmsh.model.occ.addRectangle(0.1*size, 0.1*size, (index + 1)*size/(m + 1), 0.8*size, 0.8*size), f"baffle_{index}"))
+    return names
+
+def add_disconnected_bodies(k: int, size: float = 1.0) -> list[tuple[int, int, str]]:
+    """ k separate blocks, each with a named patch on its top face """
+    names = []
+    for index in range(k):
+        x = 2*index*size
+        names.append((3, gmsh.model.occ.addBox(x, 0, 0, size, size, size), f"body_{index}"))
+        names.append((2, gmsh.model.occ.addRectangle(x, 0, size, size, size), f"top_{index}"))
+    return names
+
+def get_locations_in_mesh(kind: str, size: int) -> dict:
+    """
+    locationInMesh point of every volume of the current model at its center of mass. In the baffle
+    plate the point is moved a quarter of the baffle spacing up, so it never lies on a baffle.
+    """
+    locations = {}
+    for dim, tag in gmsh.model.getEntities(3):
+        point = list(gmsh.model.occ.getCenterOfMass(dim, tag))
+        if kind == "baffles":
+            x_min, y_min, z_min, x_max, y_max, z_max = gmsh.model.getBoundingBox(dim, tag)
+            point[2] += (z_max - z_min)/(4*(size + 1))
+        locations[validate_name(gmsh.model.getEntityName(dim, tag))] = [point]
+    return locations
+
+def write_named_step_file(step_path: str, names: list[tuple[int, int, str]], root_name: str):
+    """
+    Write the model as STEP with the given body names. gmsh does not export entity names, but it
+    writes one PRODUCT per volume and per surface not bounding a volume, in that order, named
+    "Open CASCADE STEP translator <version> <n>.<index>". These products are renamed in the file.
+    """
+    shapes = gmsh.model.getEntities(3) + [dim_tag for dim_tag in gmsh.model.getEntities(2) if not len(gmsh.model.getAdjacencies(2, dim_tag[1])[0])]
+    shape_names = {(dim, tag): entity_name for dim, tag, entity_name in names}
+    gmsh.write(step_path)
+    with open(step_path) as file:
+        text = file.read()
+    def rename(match):
+        if match.group(1) is None:
+            return f"'{root_name}'"
+        return f"'{shape_names.get(shapes[int(match.group(1)) - 1], match.group(0).strip(chr(39)))}'"
+    text = re.sub(r"'Open CASCADE STEP translator [0-9.]+ [0-9]+(?:\.([0-9]+))?'", rename, text)
+    with open(step_path, "w") as file:
+        file.write(text)
+
+def get_case_name(kind: str, size: int) -> str:
+    """ Case directory name, e.g. syntheticCubes4 """
+    return f"synthetic{kind.capitalize()}{size}"
+
+def write_synthetic_case(directory: str, kind: str, size: int) -> str:
+    """
+    Build a synthetic assembly with gmsh.model.occ and write it as a case with the STEP file in
+    constant/geometry, a controlDict and a snappyStepDict. Returns the case directory.
+    """
+    name = get_case_name(kind, size)
+    case_path = os.path.join(directory, name)
+    os.makedirs(os.path.join(case_path, "constant", "geometry"), exist_ok=True)
+    os.makedirs(os.path.join(case_path, "system"), exist_ok=True)
+    gmsh.initialize()
+    gmsh.option.setNumber("General.Terminal", 0)
+    gmsh.option.setString("Geometry.OCCTargetUnit", "M") # Write the STEP file in meters, as snappyStep reads it
+    gmsh.model.add(name)
+    if kind == "cubes":
+        names = add_touching_cubes(size)
+    elif kind == "baffles":
+        names = add_plate_with_baffles(size)
+    else:
+        names = add_disconnected_bodies(size)
+    gmsh.model.occ.synchronize()
+    step_path = os.path.join(case_path, "constant", "geometry", name + ".step")
+    write_named_step_file(step_path, names, name)
+    # Read the file back as snappyStep does, so sizes and points match the imported model
+    gmsh.clear()
+    set_import_options({"gmsh": {"scaling": 1}})
+    gmsh.model.occ.importShapes(step_path, False)
+    gmsh.model.occ.synchronize()
+    bounding_box = gmsh.model.getBoundingBox(-1, -1)
+    locations = get_locations_in_mesh(kind, size)
+    gmsh.finalize()
+    model_size = max(bounding_box[3] - bounding_box[0], bounding_box[4] - bounding_box[1], bounding_box[5] - bounding_box[2])
+    with chdir(case_path):
+        control_dict = FoamFile("./system/controlDict")
+        control_dict["application"] = "foamRun"
+        control_dict["startFrom"] = "startTime"
+        control_dict["startTime"] = 0
+        control_dict["stopAt"] = "endTime"
+        control_dict["endTime"] = 1
+        control_dict["deltaT"] = 1
+        control_dict["writeControl"] = "timeStep"
+        control_dict["writeInterval"] = 1
+        write_snappy_step_dict_template()
+        snappy_step_dict = FoamFile("./system/snappyStepDict")
+        settings = snappy_step_dict.as_dict()
+        settings["gmsh"]["meshSizeMax"] = model_size/10.0
+        settings["snappyHexMeshSetup"]["backgroundMeshSize"] = [model_size/20.0]*3
+        snappy_step_dict["gmsh"] = settings["gmsh"]
+        snappy_step_dict["snappyHexMeshSetup"] = settings["snappyHexMeshSetup"]
+        snappy_step_dict["locationInMesh"] = locations
+    print(f"Wrote {case_path}")
+    return case_path
+
+def benchmark_case(case_path: str) -> dict:
+    """
+    Run the snappyStep stages up to writing the surface meshes in the case and return the body and
+    face counts and the time of each stage in seconds.
+    """
+    os.chdir(case_path)
+    geometry_path = get_geometry_path()
+    config = read_config()
+    step_file = find_geometry_file(None, geometry_path)
+    step_name = os.path.split(step_file)[-1].split('.')[0]
+    timings = {}
+    gmsh.initialize()
+    gmsh.option.setNumber("General.Terminal", 0)
+    start = time.perf_counter()
+    load_step_file(step_file, config)
+    timings["import"] = time.perf_counter() - start
+    start = time.perf_counter()
+    imprint_geometry()
+    validate_gmsh_names()
+    timings["imprint"] = time.perf_counter() - start
+    timings["bodies"] = len(gmsh.model.getEntities(3))
+    timings["faces"] = len(gmsh.model.getEntities(2))
+    start = time.perf_counter()
+    volumes = get_volumes()
+    baffles = get_baffles(volumes)
+    timings["process"] = time.perf_counter() - start
+    start = time.perf_counter()
+    set_inside_points(volumes, config)
+    timings["insidePoints"] = time.perf_counter() - start
+    start = time.perf_counter()
+    interfaces = get_interfaces(volumes)
+    assign_cell_zones_to_interfaces(volumes)
+    timings["process"] += time.perf_counter() - start
+    start = time.perf_counter()
+    generate_surface_mesh(config, geometry_path)
+    timings["mesh"] = time.perf_counter() - start
+    start = time.perf_counter()
+    write_surface_meshes(volumes, interfaces, baffles, step_name, geometry_path)
+    timings["write"] = time.perf_counter() - start
+    gmsh.finalize()
+    return timings
+
+def print_benchmark_table(results: list[tuple[str, dict]]):
+    """ Print counts and stage timings, one row per case """
+    columns = ["bodies", "faces", "import", "imprint", "process", "insidePoints", "mesh", "write"]
+    print("case".ljust(24) + "".join(column.rjust(13) for column in columns))
+    for name, timings in results:
+        row = name.ljust(24)
+        for column in columns:
+            value = timings[column]
+            row += (f"{value:13d}" if isinstance(value, int) else f"{value:13.3f}")
+        print(row)
+
+def main_synthetic():
+    parser = argparse.ArgumentParser(description='Generate synthetic STEP assemblies of increasing size to measure how snappyStep scales')
+    parser.add_argument('kind', choices=ASSEMBLY_KINDS, help='cubes: N x N x N touching cubes. baffles: block with N embedded baffles. bodies: N disconnected bodies with named faces')
+    parser.add_argument('sizes', type=int, nargs='+', help='N for each case to generate')
+    parser.add_argument('-directory', default='.', help='Directory to write the cases in')
+    parser.add_argument('-benchmark', action='store_true', help='Time the snappyStep stages on every generated case')
+    args = parser.parse_args()
+
+    case_paths = [write_synthetic_case(args.directory, args.kind, size) for size in args.sizes]
+    if not args.benchmark:
+        return
+    results = []
+    for case_path in case_paths:
+        # Fresh process per case, so gmsh state and the Baffle face list do not carry over
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results.append((os.path.basename(case_path), executor.submit(benchmark_case, os.path.abspath(case_path)).result()))
+    print_benchmark_table(results)